@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+"""\
+Benchmark the database that two_cents uses.
+
+The 'queries' benchmark times the queries that two_cents makes most often
+against a database full of fake payments, and shows the plan SQLite uses for
+each one (i.e. which indexes it uses).
+
+The 'pragmas' benchmark compares SQLite's default settings (as configured by
+Python's sqlite3 module) with the pragmas that open_db() applies.  It times
+how long it takes to ingest payments in many small transactions (like a
+download does), and counts how many queries another connection can make in
+the meantime (like show_budgets would).
+
+Usage:
+    benchmark.py queries [<num_payments>] [-b <num_budgets>] [-o <path>]
+    benchmark.py pragmas [<num_payments>] [-d <dir>]
+
+Options:
+  -b, --num-budgets <num>   [default: 20]
+        How many budgets to spread the payments across.
+
+  -o, --output <path>
+        Where to create the database.  By default a temporary file is used,
+        and deleted when the benchmark finishes.
+
+  -d, --dir <dir>
+        Where to create the temporary databases for the pragmas benchmark.
+        Use a directory on the same disk as your real database, because the
+        cost of syncing to disk (which is what most of the pragmas are about)
+        depends a lot on the disk.
+"""
+
+import datetime
+import docopt
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+import two_cents
+
+# Undo the pragmas that open_db() applies by default, i.e. go back to the 
+# settings two_cents had before it applied any pragmas.  The exception is 
+# busy_timeout: SQLite's own default is 0, but Python's sqlite3 module has 
+# always set it to 5000 (via the timeout argument to connect()), so that's the 
+# baseline two_cents really had.  With 0, the reader would just fail with 
+# "database is locked" in DELETE mode instead of measuring anything.
+default_pragmas = {
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+        'cache_size': -2000,
+        'mmap_size': 0,
+        'busy_timeout': 5000,
+}
+
+def main():
+    args = docopt.docopt(__doc__)
+
+    if args['pragmas']:
+        num_payments = int(args['<num_payments>'] or 20000)
+        for title, pragmas in [
+                ("sqlite3 defaults", default_pragmas),
+                ("two_cents pragmas", None)]:
+            print(title)
+            benchmark_pragmas(num_payments, pragmas, args['--dir'])
+        return
+
+    num_payments = int(args['<num_payments>'] or 100000)
+    num_budgets = int(args['--num-budgets'])
+
+    with tempfile.TemporaryDirectory() as dir:
+        path = args['--output'] or os.path.join(dir, 'benchmark.db')
+
+        with two_cents.open_db(path) as session:
+            fill_database(session, num_payments, num_budgets)
+
+        with two_cents.open_db(path) as session:
+            run_benchmarks(session)
+
+def fill_database(session, num_payments, num_budgets, chunk_size=10000):
+    bank = two_cents.Bank(session, 'wells_fargo')
+    session.add(bank)
+
+    budgets = [two_cents.Budget('budget {}'.format(i)) for i in range(num_budgets)]
+    session.add_all(budgets)
+    session.flush()
+
+    today = datetime.date.today()
+    budget_ids = [x.id for x in budgets]
+    table = two_cents.Payment.__table__
+
+    # Leave about 1% of the payments unassigned, like there would be after a
+    # typical download.
+
+    def fake_payment(i):
+        assigned = random.random() > 0.01
+        return dict(
+                bank_id=bank.id,
+                account_id='0000000000000000',
+                transaction_id='txn {}'.format(i),
+                date=today - datetime.timedelta(days=random.randrange(3650)),
+                value=-random.randrange(1, 100000) / 100,
+                description='PAYMENT #{}'.format(i),
+                budget_id=random.choice(budget_ids) if assigned else None,
+                ignored=False,
+        )
+
+    for start in range(0, num_payments, chunk_size):
+        stop = min(start + chunk_size, num_payments)
+        session.execute(table.insert(), [fake_payment(i) for i in range(start, stop)])
+
+def run_benchmarks(session):
+    budgets = two_cents.get_budgets(session)
+    last_month = datetime.date.today() - datetime.timedelta(days=30)
+
+    benchmarks = [
+            ("Count unassigned payments",
+                lambda: two_cents.get_num_unassigned_payments(session)),
+            ("Get unassigned payments",
+                lambda: two_cents.get_unassigned_payments(session)),
+            ("Get payments for one budget",
+                lambda: two_cents.get_payments(session, budgets[0].name)),
+            ("Get last month's payments",
+                lambda: list(two_cents.iter_payments(session, since=last_month))),
+            ("Get last month's payments for one budget",
+                lambda: list(two_cents.iter_payments(
+                    session, budgets[0].name, since=last_month))),
+            ("Suggest allowances",
+                lambda: two_cents.suggest_allowances(session, budgets)),
+    ]
+
+    for title, function in benchmarks:
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+
+        print('{}: {:.1f} ms'.format(title, 1000 * elapsed))
+        for step in two_cents.get_query_plan(session, function):
+            print('    ' + step)
+
+def benchmark_pragmas(num_payments, pragmas, dir=None, batch_size=100):
+    from two_cents.ofx import Transaction
+
+    with tempfile.TemporaryDirectory(dir=dir) as dir:
+        path = os.path.join(dir, 'benchmark.db')
+
+        with two_cents.open_db(path, pragmas) as session:
+            fill_database(session, 1000, 20)
+            session.add(two_cents.Bank(session, 'wells_fargo_ofx'))
+
+        # Query the database as fast as possible from another process while 
+        # payments are being ingested, like show_budgets would if it were run 
+        # during a background download.
+
+        done = multiprocessing.Event()
+        num_reads = multiprocessing.Value('i', 0)
+        max_latency = multiprocessing.Value('d', 0)
+        reader = multiprocessing.Process(
+                target=read_continuously,
+                args=(path, pragmas, done, num_reads, max_latency))
+        reader.start()
+
+        with two_cents.open_db(path, pragmas) as session:
+            bank = two_cents.get_bank(session, 'wells_fargo_ofx')
+            today = datetime.date.today()
+
+            start = time.perf_counter()
+            for i in range(0, num_payments, batch_size):
+                transactions = [
+                        ('1111222233334444', Transaction(
+                            'txn {}'.format(j), today, '-1.00', 'PAYEE', 'MEMO'))
+                        for j in range(i, i + batch_size)
+                ]
+                two_cents.ingest_transactions(session, bank, transactions)
+                session.commit()
+            elapsed = time.perf_counter() - start
+
+        done.set()
+        reader.join()
+
+        print('    Ingested {} payments in {} transactions: {:.2f} s'.format(
+            num_payments, num_payments // batch_size, elapsed))
+        print('    Concurrent reads: {} ({:.0f}/s, slowest {:.1f} ms)'.format(
+            num_reads.value, num_reads.value / elapsed, 1000 * max_latency.value))
+
+def read_continuously(path, pragmas, done, num_reads, max_latency):
+    with two_cents.open_db(path, pragmas) as session:
+        while not done.is_set():
+            start = time.perf_counter()
+            two_cents.get_num_unassigned_payments(session)
+            two_cents.get_budgets(session)
+            session.rollback()
+            latency = time.perf_counter() - start
+
+            num_reads.value += 1
+            max_latency.value = max(max_latency.value, latency)
+
+
+if __name__ == '__main__':
+    main()
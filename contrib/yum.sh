@@ -2,7 +2,6 @@
 
 sudo yum install            \
     python3                 \
-    python3-ofxparse        \
     python3-requests        \
     python3-sqlalchemy      \
     python3-PyYAML          \
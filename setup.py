@@ -25,20 +25,29 @@ setup(
     packages=[
         'two_cents',
     ],
+    py_modules=[
+        'two_cents_client',
+    ],
     entry_points = {
-        'console_scripts': ['two_cents=two_cents.cli:main'],
+        'console_scripts': [
+            'two_cents=two_cents.cli:main',
+            'two_cents_client=two_cents_client:main',
+        ],
     },
     include_package_data=True,
+    python_requires='>=3.7',
     install_requires=[
-        'SQLAlchemy',
+        'SQLAlchemy>=1.4.24',
         'selenium',
         'xvfbwrapper',
-        'ofxparse',
         'docopt==0.6.2',
         'appdirs',
         'pathlib',
         'prettytable',
     ],
+    extras_require={
+        'arrow': ['pyarrow'],
+    },
     zip_safe=False,
     keywords=[
         'two_cents',
@@ -47,8 +56,10 @@ setup(
         'Development Status :: 2 - Pre-Alpha',
         'Natural Language :: English',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
 )
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import pytest, two_cents
+from two_cents.model import days_per_month
 from test_helpers import *
 
 def test_open_db(fresh_test_db):
@@ -26,6 +27,195 @@ def test_open_db(fresh_test_db):
         assert two_cents.get_num_banks(session) == 0
         assert two_cents.get_num_budgets(session) == 0
 
+def test_sqlite_pragmas(fresh_test_db):
+    def pragma(session, key):
+        return session.connection().exec_driver_sql('PRAGMA ' + key).scalar()
+
+    with open_test_db() as session:
+        assert pragma(session, 'journal_mode') == 'wal'
+        assert pragma(session, 'synchronous') == 1
+        assert pragma(session, 'mmap_size') == 256 * 1024**2
+
+    with two_cents.open_db(test_db_path, pragmas={'synchronous': 'FULL', 'mmap_size': None}) as session:
+        assert pragma(session, 'synchronous') == 2
+        assert pragma(session, 'mmap_size') == 0
+
+def test_persistent_engines(fresh_test_db):
+    import sqlite3
+
+    def open_persistent_db(pragmas=None):
+        return two_cents.open_db(test_db_path, pragmas, persistent=True)
+
+    def get_engine(pragmas=None):
+        with open_persistent_db(pragmas) as session:
+            return session.get_bind()
+
+    try:
+        engine = get_engine()
+        assert get_engine() is engine
+
+        # Different pragmas need different connections.
+
+        with open_persistent_db({'mmap_size': None}) as session:
+            assert session.get_bind() is not engine
+            assert session.connection().exec_driver_sql('PRAGMA mmap_size').scalar() == 0
+
+        # The schema should be checked every time, in case another process 
+        # changed it.
+
+        db = sqlite3.connect(test_db_path)
+        db.execute('UPDATE schema_version SET version = version + 1')
+        db.commit()
+        db.close()
+
+        with pytest.raises(two_cents.UserError, match="newer version"):
+            get_engine()
+
+        # If the database is replaced, the cached engine shouldn't be used.
+
+        remove_test_db()
+        with open_persistent_db() as session:
+            assert session.get_bind() is not engine
+            assert two_cents.get_num_budgets(session) == 0
+
+    finally:
+        two_cents.dispose_engines()
+
+    assert two_cents.model.engines == {}
+
+def test_schema_migrations(fresh_test_db, monkeypatch):
+    import sqlite3, sqlalchemy
+    from two_cents import migrations
+
+    def get_version():
+        db = sqlite3.connect(test_db_path)
+        try: return db.execute('SELECT version FROM schema_version').fetchall()
+        finally: db.close()
+
+    with open_test_db():
+        pass
+
+    assert get_version() == [(len(migrations.migrations),)]
+
+    # Once the database is up to date, checking that it's up to date should 
+    # only take one query.
+
+    statements = []
+    engine = sqlalchemy.create_engine('sqlite:///' + test_db_path)
+    sqlalchemy.event.listen(engine, 'before_cursor_execute',
+            lambda *args: statements.append(args[2]))
+    migrations.upgrade_db(engine)
+    engine.dispose()
+
+    assert statements == ['SELECT schema_version.version \nFROM schema_version']
+
+    # If a migration fails, the database should be left exactly as it was.
+
+    def fail(connection):
+        raise ZeroDivisionError
+
+    remove_test_db()
+    make_legacy_test_db(payments=[(-10, 'groceries')], budgets=[('groceries', -10, 0)])
+    monkeypatch.setattr(migrations, 'migrations', migrations.migrations + [fail])
+
+    with pytest.raises(ZeroDivisionError):
+        with open_test_db():
+            pass
+
+    db = sqlite3.connect(test_db_path)
+    tables = db.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name").fetchall()
+    payments = db.execute('SELECT value, assignment FROM payments').fetchall()
+    db.close()
+
+    assert tables == [('banks',), ('budgets',), ('payments',)]
+    assert payments == [(-10.0, 'groceries')]
+
+def test_upgrade_watermarks(fresh_test_db):
+    import sqlite3
+    from two_cents import migrations
+
+    # Make a database like the ones created while watermarks recorded the 
+    # latest transaction id, and which hasn't run the newest migration.
+
+    with open_test_db():
+        pass
+
+    db = sqlite3.connect(test_db_path)
+    db.executescript("""
+        DROP TABLE watermarks;
+        CREATE TABLE watermarks (
+            id INTEGER NOT NULL, bank_id INTEGER NOT NULL,
+            account_id VARCHAR NOT NULL, date DATE NOT NULL,
+            transaction_id VARCHAR, PRIMARY KEY (id),
+            UNIQUE (bank_id, account_id));
+        INSERT INTO banks VALUES (1, 'wells_fargo', NULL, NULL, '2014-01-01 00:00:00.000000');
+        INSERT INTO watermarks VALUES (1, 1, '1111222233334444', '2013-12-25', 'txn-1');
+    """)
+    db.execute('UPDATE schema_version SET version = ?', (len(migrations.migrations) - 1,))
+    db.commit()
+    db.close()
+
+    with open_test_db() as session:
+        bank = two_cents.get_bank(session, 'wells_fargo')
+        assert two_cents.get_watermarks(session, bank) == {
+                '1111222233334444': datetime.date(2013, 12, 25)}
+
+    db = sqlite3.connect(test_db_path)
+    columns = [x[1] for x in db.execute('PRAGMA table_info(watermarks)')]
+    db.close()
+
+    assert columns == ['id', 'bank_id', 'account_id', 'date']
+
+def test_upgrade_money_columns(fresh_test_db):
+    import sqlite3
+
+    make_legacy_test_db(
+            payments=[(-100.10, 'groceries'), (0.1 + 0.2, None)],
+            budgets=[('groceries', -100.10, 150 / days_per_month)],
+    )
+
+    with open_test_db() as session:
+        groceries = two_cents.get_budget(session, 'groceries')
+        payments = two_cents.get_payments(session)
+
+        assert groceries.balance == pytest.approx(-100.10)
+        assert groceries.allowance == pytest.approx(150 / days_per_month)
+        assert [x.value for x in payments] == [-100.10, 0.30]
+
+    # The money should now be stored as exact integers.
+
+    db = sqlite3.connect(test_db_path)
+    assert db.execute('SELECT value FROM payments').fetchall() == [(-10010,), (30,)]
+    assert db.execute('SELECT balance FROM budgets').fetchall() == [(-10010000000,)]
+    assert db.execute('SELECT typeof(allowance) FROM budgets').fetchall() == [('integer',)]
+    db.close()
+
+def test_upgrade_assignments(fresh_test_db):
+    make_legacy_test_db(
+            payments=[
+                (-10, 'groceries'),
+                (-20, None),
+                (-30, 'ignore'),
+                (-40, 'deleted budget'),
+            ],
+            budgets=[('groceries', -10, 0)],
+    )
+
+    with open_test_db() as session:
+        groceries = two_cents.get_budget(session, 'groceries')
+        payments = two_cents.get_payments(session)
+
+        assert [x.assignment for x in payments] == \
+                ['groceries', None, 'ignore', 'ignore']
+        assert payments[0].budget is groceries
+        assert two_cents.get_num_unassigned_payments(session) == 1
+
+        # Payments that were assigned to deleted budgets used to be impossible 
+        # to reassign.
+
+        payments[3].assign('groceries')
+        assert groceries.balance == -50
+
 def test_budget_schema(fresh_test_db):
     with open_test_db() as session:
         assert two_cents.get_budgets(session) == []
@@ -51,6 +241,18 @@ def test_budget_schema(fresh_test_db):
         assert budgets[0].recovery_time == 0
         assert budgets[1].recovery_time == -1
 
+        assert two_cents.get_budgets(session, 'restaurants') == [budgets[1]]
+        assert two_cents.get_budgets(session, 'restaurants', 'nonexistant-budget') == [budgets[1]]
+        assert two_cents.get_budgets(session, order_by='balance') == [budgets[1], budgets[0]]
+        assert two_cents.get_budgets(session, order_by='name') == budgets
+        assert two_cents.get_budgets_by_name(session, ['restaurants', 'groceries']) == {
+                'groceries': budgets[0], 'restaurants': budgets[1]}
+
+        with pytest.raises(two_cents.UserError):
+            two_cents.get_budgets(session, order_by='nonexistant-key')
+        with pytest.raises(two_cents.NoSuchBudget):
+            two_cents.get_budgets_by_name(session, ['groceries', 'nonexistant-budget'])
+
         with pytest.raises(two_cents.UserError):
             add_budget(session, 'skip')
         with pytest.raises(two_cents.UserError):
@@ -74,6 +276,26 @@ def test_budget_schema(fresh_test_db):
         assert budgets[1].pretty_balance == '$1.92'
         assert budgets[1].recovery_time == 0
 
+def test_forecast_balances(fresh_test_db):
+    with open_test_db() as session:
+        bank, payments, budgets = fill_database(session)
+        budgets[0].allowance = two_cents.parse_allowance('10 per day')
+        budgets[1].allowance = two_cents.parse_allowance('1000 per day')
+        budgets[1].balance = -100
+
+        # Make sure the arithmetic doesn't overflow over long periods of time.
+
+        forecast = two_cents.forecast_balances(session, test_dates['next year'])
+        assert forecast == {budgets[0]: 3650, budgets[1]: 364900}
+        assert budgets[0].balance == 0
+
+        change_date('next year')
+        two_cents.update_allowances(session)
+
+        assert budgets[0].balance == 3650
+        assert budgets[1].balance == 364900
+        assert budgets[0].last_update == budgets[1].last_update == test_dates['next year']
+
 def test_payment_schema(fresh_test_db):
     with open_test_db() as session:
         assert two_cents.get_payments(session) == []
@@ -131,6 +353,31 @@ def test_payment_schema(fresh_test_db):
         assert groceries.balance == pytest.approx(10)
         assert restaurants.balance == pytest.approx(-10)
 
+def test_payment_indexes(fresh_test_db):
+    with open_test_db() as session:
+        bank, payments, budgets = fill_database(session)
+        session.flush()
+
+        def uses_index(function, index):
+            plan = two_cents.get_query_plan(session, function)
+            return plan[0].startswith('SEARCH payments') and index in plan[0]
+
+        by_budget = 'ix_payments_budget_date'
+
+        assert uses_index(lambda: two_cents.get_num_unassigned_payments(session), by_budget)
+        assert uses_index(lambda: two_cents.get_unassigned_payments(session), by_budget)
+        assert uses_index(lambda: two_cents.get_payments(session, 'groceries'), by_budget)
+        assert uses_index(lambda: two_cents.suggest_allowances(session, budgets), by_budget)
+        assert uses_index(lambda: list(two_cents.iter_payments(
+            session, 'groceries', since=test_dates['today'])), by_budget)
+
+        # Looking up known transactions should use every column of the 
+        # unique index, not just the bank.
+
+        assert uses_index(lambda: two_cents.get_payment_keys(
+            session, bank, [('0000000000000000', 'transaction id 0')]),
+            'ix_payments_bank_account_transaction (bank_id=? AND account_id=? AND transaction_id=?)')
+
 def test_bank_schema(fresh_test_db):
     with open_test_db() as session:
         assert two_cents.get_num_banks(session) == 0
@@ -152,6 +399,309 @@ def test_bank_schema(fresh_test_db):
         with pytest.raises(two_cents.UserError):
             add_bank(session, 'nonexistant_scraper')
 
+def test_rule_matcher(fresh_test_db):
+    with open_test_db() as session:
+        bank, payments, budgets = fill_database(session)
+
+        def rule(pattern=None, min=None, max=None, account=None):
+            return two_cents.Rule(session, 'groceries', pattern, min, max, account)
+
+        rules = [
+                rule('he'),
+                rule('SHE'),
+                rule('his'),
+                rule('hers'),
+                rule('market', min=50),
+                rule(max=5),
+                rule('market', account='1234'),
+        ]
+        matcher = two_cents.RuleMatcher(rules)
+
+        assert matcher.find('ushers') == {0, 1, 3, 5}
+        assert matcher.find('This') == {2, 5}
+        assert matcher.find('') == {5}
+        assert matcher.find('SUPERMARKET') == {4, 5, 6}
+
+        assert matcher.match('ushers', '0000', -100) is rules[0]
+        assert matcher.match('supermarket', '0000', -100) is rules[4]
+        assert matcher.match('supermarket', '0000', -10) is None
+        assert matcher.match('supermarket', '0000', -1) is rules[5]
+        assert matcher.match('supermarket', '1234', -10) is rules[6]
+
+        with pytest.raises(two_cents.UserError):
+            rule()
+        with pytest.raises(two_cents.NoSuchBudget):
+            two_cents.Rule(session, 'no-such-budget', 'pattern')
+
+def test_apply_rules(fresh_test_db):
+    with open_test_db() as session:
+        bank, payments, budgets = fill_database(session)
+        payments += [add_payment(bank, -1), add_payment(bank, -2)]
+        payments[0].description = 'SAFEWAY #123'
+        payments[1].description = 'Pizza Place'
+        payments[2].description = 'Safeway #456'
+        payments[3].description = 'ATM fee'
+        payments[2].assign('restaurants')
+
+        assert two_cents.apply_rules(session) == 0
+
+        session.add_all([
+                two_cents.Rule(session, 'groceries', 'safeway'),
+                two_cents.Rule(session, 'restaurants', 'pizza'),
+                two_cents.Rule(session, 'ignore', 'atm', max_amount=5),
+        ])
+        assert two_cents.apply_rules(session) == 3
+        assert [x.assignment for x in payments] == \
+                ['groceries', 'restaurants', 'restaurants', 'ignore']
+        assert budgets[0].balance == -100
+        assert budgets[1].balance == -11
+        assert two_cents.get_num_unassigned_payments(session) == 0
+
+        # Rules for a budget are removed along with it.
+
+        two_cents.remove_budget(session, 'groceries')
+        assert [x.assignment for x in two_cents.get_rules(session)] == \
+                ['restaurants', 'ignore']
+
+def test_assignment_suggester(fresh_test_db):
+    import time
+
+    with open_test_db() as session:
+        bank, payments, budgets = fill_database(session)
+        descriptions = [
+                ('SAFEWAY #123', 'groceries'),
+                ('SAFEWAY #456', 'groceries'),
+                ('TRADER JOES', 'groceries'),
+                ('PIZZA PLACE', 'restaurants'),
+                ('THAI PLACE', 'restaurants'),
+                ('ATM FEE', 'ignore'),
+                ('UNKNOWN PLACE', None),
+        ]
+        for description, assignment in descriptions:
+            payment = add_payment(bank)
+            payment.description = description
+            if assignment: payment.assign(assignment)
+
+        suggester = two_cents.get_assignment_suggester(session)
+        suggest = lambda x: [k for k, v in suggester.suggest(x)]
+
+        assert suggest('SAFEWAY #789') == ['groceries']
+        assert suggest('Burger Place') == ['restaurants']
+        assert suggest('ATM Fee #1') == ['ignore']
+        assert suggest('Safeway Pizza')[0] == 'groceries'
+        assert suggest('Nothing familiar') == []
+
+        # Descriptions are only tokenized once, but the suggestions follow the 
+        # payments when they're reassigned.
+
+        tokens = session.query(two_cents.PaymentToken).count()
+        two_cents.rename_budget(session, 'restaurants', 'dining out')
+        payment = add_payment(bank)
+        payment.description = 'Pizza Palace'
+
+        suggester = two_cents.get_assignment_suggester(session)
+        assert suggest('Pizza') == ['dining out']
+        assert session.query(two_cents.PaymentToken).count() == tokens + 2
+
+        start = time.perf_counter()
+        for i in range(1000):
+            suggester.suggest('SAFEWAY STORE #{}'.format(i))
+        assert time.perf_counter() - start < 1
+
+def test_lazy_scrapers():
+    import sys, subprocess
+
+    # Importing two_cents shouldn't import the scrapers, because they depend 
+    # on selenium, which is slow to import.
+
+    script = 'import sys, two_cents; print(sorted(sys.modules))'
+    modules = subprocess.check_output([sys.executable, '-c', script])
+
+    assert b"'two_cents.model'" in modules
+    assert b"'two_cents.banks'" not in modules
+    assert b"'selenium'" not in modules
+
+    scraper = two_cents.find_scraper('wells_fargo')
+    assert scraper.title == 'Wells Fargo'
+    assert scraper.load().__name__ == 'WellsFargo'
+
+    with pytest.raises(two_cents.NoSuchScraper):
+        two_cents.find_scraper('nonexistant_scraper')
+
+def test_download_payments(fresh_test_db, fake_scraper):
+    checking = fake_scraper.add_account('1111222233334444')
+    savings = fake_scraper.add_account('5555666677778888')
+
+    add_transaction(checking, 'txn-1', -100)
+    add_transaction(checking, 'txn-2', -10)
+    add_transaction(savings, 'txn-1', 50)
+
+    with open_test_db() as session:
+        add_bank(session, 'fake_bank')
+        result = download_fake_payments(session)
+
+        assert result.inserted == 3
+        assert result.duplicates == 0
+        assert len(two_cents.get_payments(session)) == 3
+        assert two_cents.get_num_unassigned_payments(session) == 3
+
+    # Downloading the same transactions again shouldn't create any new 
+    # payments, even if the statement itself contains duplicates.
+
+    add_transaction(checking, 'txn-2', -10)
+    add_transaction(checking, 'txn-3', -1)
+
+    with open_test_db() as session:
+        result = download_fake_payments(session)
+
+        assert result.inserted == 1
+        assert result.duplicates == 4
+
+        payments = two_cents.get_payments(session)
+        keys = sorted((x.account_id, x.transaction_id) for x in payments)
+
+        assert keys == [
+                ('1111222233334444', 'txn-1'),
+                ('1111222233334444', 'txn-2'),
+                ('1111222233334444', 'txn-3'),
+                ('5555666677778888', 'txn-1'),
+        ]
+
+def test_watermarks(fresh_test_db, fake_scraper):
+    from datetime import timedelta
+    checking = fake_scraper.add_account('1111222233334444')
+    savings = fake_scraper.add_account('5555666677778888')
+
+    add_transaction(checking, 'txn-1', date='today')
+    add_transaction(savings, 'txn-2', date='today')
+
+    overlap = two_cents.model.watermark_overlap
+    window = two_cents.model.download_window
+
+    def get_watermarks():
+        with open_test_db() as session:
+            bank = two_cents.get_bank(session, 'fake_bank')
+            return two_cents.get_watermarks(session, bank)
+
+    with open_test_db() as session:
+        add_bank(session, 'fake_bank')
+        download_fake_payments(session)
+
+    assert get_watermarks() == {
+            '1111222233334444': test_dates['today'].date(),
+            '5555666677778888': test_dates['today'].date(),
+    }
+
+    # The savings account goes dormant, so the scraper stops returning it 
+    # (like the Wells Fargo website does for accounts with no activity).  
+    # Its watermark shouldn't advance, but it also shouldn't make the 
+    # downloads start any earlier than they would without watermarks.
+
+    fake_scraper.accounts = [checking]
+
+    change_date('next month')
+    with open_test_db() as session:
+        download_fake_payments(session)
+
+    assert get_watermarks() == {
+            '1111222233334444': test_dates['next month'].date(),
+            '5555666677778888': test_dates['today'].date(),
+    }
+
+    change_date('next year')
+    with open_test_db() as session:
+        download_fake_payments(session)
+
+    first, second, third = fake_scraper.downloads
+    earliest = (test_dates['next month'] - window).date()
+
+    assert first == (test_dates['today'] - window, {})
+    assert second == (test_dates['today'].date() - overlap, {
+            '1111222233334444': test_dates['today'].date() - overlap,
+            '5555666677778888': test_dates['today'].date() - overlap,
+    })
+    assert third == (earliest, {
+            '1111222233334444': test_dates['next month'].date() - overlap,
+            '5555666677778888': earliest,
+    })
+
+    # Watermarks should never move backwards.
+
+    with open_test_db() as session:
+        bank = two_cents.get_bank(session, 'fake_bank')
+        two_cents.update_watermarks(session, bank,
+                ['1111222233334444'], test_dates['today'].date())
+
+    assert get_watermarks()['1111222233334444'] == test_dates['next year'].date()
+
+def test_download_payments_from_many_banks(fresh_test_db, fake_scraper):
+    two_cents.register_scraper(
+            'other_fake_bank', 'Other Fake Bank', 'test_helpers:FakeScraper')
+
+    account = fake_scraper.add_account('1111222233334444')
+    add_transaction(account, 'txn-1', -100)
+    add_transaction(account, 'txn-2', -10)
+
+    try:
+        with open_test_db() as session:
+            for key in 'fake_bank', 'other_fake_bank':
+                bank = add_bank(session, key)
+                bank.username_command = 'echo username'
+                bank.password_command = 'echo password'
+
+            results = two_cents.download_payments(
+                    session, None, None, workers=2)
+
+            assert results == [(2, 0), (2, 0)]
+            assert len(two_cents.get_payments(session)) == 4
+
+            for bank in two_cents.get_banks(session):
+                assert len(bank.payments) == 2
+    finally:
+        del two_cents.scrapers['other_fake_bank']
+
+def test_download_payments_legacy_scraper(fresh_test_db, fake_scraper):
+    from datetime import timedelta
+    two_cents.register_scraper(
+            'legacy_bank', 'Legacy Bank', 'test_helpers:LegacyScraper')
+
+    account = fake_scraper.add_account('1111222233334444')
+    add_transaction(account, 'txn-1', -100, date='next week')
+
+    try:
+        with open_test_db() as session:
+            bank = add_bank(session, 'legacy_bank')
+            bank.username_command = 'echo username'
+            bank.password_command = 'echo password'
+
+            assert bank.download_payments(None, None) == (1, 0)
+            assert bank.download_payments(None, None) == (0, 1)
+    finally:
+        del two_cents.scrapers['legacy_bank']
+
+    overlap = two_cents.model.watermark_overlap
+    assert fake_scraper.downloads == [
+            (test_dates['today'] - timedelta(days=30), None),
+            (test_dates['today'].date() - overlap, None),
+    ]
+
+def test_ingest_transactions(fresh_test_db, fake_scraper):
+    account = fake_scraper.add_account('1111222233334444')
+
+    for i in range(10):
+        add_transaction(account, 'txn-{}'.format(i % 7), -i)
+
+    with open_test_db() as session:
+        bank = add_bank(session, 'fake_bank')
+        transactions = two_cents.iter_transactions(fake_scraper.accounts)
+        result = two_cents.ingest_transactions(
+                session, bank, transactions, batch_size=3)
+
+        assert result == (7, 3)
+        assert len(bank.payments) == 7
+        assert sorted(x.value for x in bank.payments) == [-6, -5, -4, -3, -2, -1, 0]
+        assert all(x.date == test_dates['today'].date() for x in bank.payments)
+
 def test_suggest_allowance(fresh_test_db):
     with open_test_db() as session:
         bank, payments, budgets = fill_database(session)
@@ -170,6 +720,14 @@ def test_suggest_allowance(fresh_test_db):
         assert two_cents.suggest_allowance(session, budgets[0]) == pytest.approx(100 * 365 / 12)
         assert two_cents.suggest_allowance(session, budgets[1]) == pytest.approx(10 * 365 / 12)
 
+        add_payment(bank, -50, date='tomorrow').assign(budgets[0].name)
+        change_date('next week')
+
+        assert two_cents.suggest_allowances(session, budgets) == {
+                budgets[0]: pytest.approx(150 / 7 * 365 / 12),
+                budgets[1]: pytest.approx(10 / 7 * 365 / 12),
+        }
+
 def test_rename_budget(fresh_test_db):
     with open_test_db() as session:
         bank, payments, budgets = fill_database(session)
@@ -183,6 +741,84 @@ def test_rename_budget(fresh_test_db):
         assert two_cents.get_payments(session, 'groceries') == []
         assert two_cents.get_payments(session, 'joint groceries') == [payments[0]]
 
+def test_iter_payments(fresh_test_db):
+    with open_test_db() as session:
+        bank, payments, budgets = fill_database(session)
+        payments += [
+                add_payment(bank, -1, 'tomorrow'),
+                add_payment(bank, -2, 'next week'),
+                add_payment(bank, -3, 'next month'),
+        ]
+        for payment in payments[1::2]:
+            payment.assign('groceries')
+
+        def iter_payments(*args, **kwargs):
+            return list(two_cents.iter_payments(session, *args, page_size=2, **kwargs))
+
+        assert iter_payments() == payments
+        assert iter_payments(limit=3) == payments[:3]
+        assert iter_payments(limit=4) == payments[:4]
+        assert iter_payments(limit=0) == []
+        assert iter_payments('groceries') == payments[1::2]
+        assert iter_payments(since=test_dates['tomorrow']) == payments[2:]
+        assert iter_payments(until=test_dates['next week']) == payments[:4]
+        assert iter_payments(
+                since=test_dates['tomorrow'],
+                until=test_dates['next week']) == payments[2:4]
+
+def test_assign_payments(fresh_test_db):
+    with open_test_db() as session:
+        bank, payments, budgets = fill_database(session)
+        payments += [add_payment(bank, -1), add_payment(bank, -1000)]
+        payments[0].description = 'SAFEWAY #123'
+        payments[1].description = 'Safeway #456'
+        payments[0].assign('restaurants')
+        payments[3].assign('ignore')
+
+        query = two_cents.query_payments(session, description='safeway')
+        assert two_cents.assign_payments(session, query, 'groceries') == 2
+        assert [x.assignment for x in payments] == \
+                ['groceries', 'groceries', None, 'ignore']
+        assert budgets[0].balance == -110
+        assert budgets[1].balance == 0
+
+        # Payments that are already assigned to the budget are left alone.
+
+        query = two_cents.query_payments(session, ids=[1, 2, 3, 4])
+        assert two_cents.assign_payments(session, query, 'groceries') == 2
+        assert [x.assignment for x in payments] == ['groceries'] * 4
+        assert budgets[0].balance == -1111
+
+        query = two_cents.query_payments(session, budget_name='groceries')
+        assert two_cents.assign_payments(session, query, 'ignore') == 4
+        assert [x.assignment for x in payments] == ['ignore'] * 4
+        assert budgets[0].balance == 0
+
+        with pytest.raises(two_cents.NoSuchBudget):
+            two_cents.assign_payments(session, query, 'no-such-budget')
+        with pytest.raises(two_cents.NoSuchPayment):
+            two_cents.check_payment_ids(session, [1, 42])
+        with pytest.raises(two_cents.NoSuchPayment):
+            two_cents.check_payment_ids(session, ['wrong-type'])
+
+def test_remove_budget(fresh_test_db):
+    with open_test_db() as session:
+        bank, payments, budgets = fill_database(session)
+        payments[0].assign('groceries')
+        payments[1].assign('restaurants')
+
+        two_cents.remove_budget(session, 'groceries')
+        assert not two_cents.budget_exists(session, 'groceries')
+        assert payments[0].assignment == 'ignore'
+        assert payments[1].assignment == 'restaurants'
+        assert two_cents.get_num_unassigned_payments(session) == 0
+
+        with pytest.raises(two_cents.NoSuchBudget):
+            two_cents.remove_budget(session, 'groceries')
+
+        payments[0].assign('restaurants')
+        assert budgets[1].balance == -110
+
 def test_transfer_money(fresh_test_db):
     with open_test_db() as session:
         bank, payments, budgets = fill_database(session)
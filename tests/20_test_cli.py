@@ -98,6 +98,125 @@ def test_add_budget(fresh_test_db):
         assert budget.allowance == pytest.approx(20 * 12 / 365)
         assert budget.last_update == test_dates['today']
 
+def test_export(fresh_test_db, tmpdir, monkeypatch):
+    import csv, sys
+
+    with open_test_db() as session:
+        bank, payments, budgets = fill_database(session)
+        add_payment(bank, -1, 'tomorrow')
+        payments[0].assign('groceries')
+        payments[1].assign('ignore')
+
+    def read_csv(name):
+        with tmpdir.join('out', name + '.csv').open() as file:
+            return list(csv.reader(file))
+
+    assert "Exported 3 payments, 2 budgets, and 1 bank to" in \
+            run_two_cents('export {}'.format(tmpdir.join('out')))
+
+    assert read_csv('payments') == [
+            ['id', 'bank', 'account_id', 'date', 'value', 'budget', 'ignored', 'description'],
+            ['1', 'wells_fargo', '0000000000000000', '2014-01-01', '-100.0', 'groceries', 'False', 'description...'],
+            ['2', 'wells_fargo', '0000000000000000', '2014-01-01', '-10.0', '', 'True', 'description...'],
+            ['3', 'wells_fargo', '0000000000000000', '2014-01-02', '-1.0', '', 'False', 'description...'],
+    ]
+    assert read_csv('budgets') == [
+            ['id', 'name', 'balance', 'allowance_per_day', 'last_update'],
+            ['1', 'groceries', '-100.0', '0.0', '2014-01-01 00:00:00'],
+            ['2', 'restaurants', '0.0', '0.0', '2014-01-01 00:00:00'],
+    ]
+    assert read_csv('banks') == [
+            ['id', 'scraper_key', 'title', 'last_update'],
+            ['1', 'wells_fargo', 'Wells Fargo', '2014-01-01 00:00:00'],
+    ]
+
+    assert "Exported 1 payment, 1 budget, and 1 bank to" in \
+            run_two_cents('export {} groceries'.format(tmpdir.join('out')))
+    assert "Exported 1 payment, 2 budgets, and 1 bank to" in \
+            run_two_cents('export {} --since 2014-01-02'.format(tmpdir.join('out')))
+
+    assert "Can't export to 'xlsx'" in \
+            run_two_cents('export {} --format xlsx'.format(tmpdir))
+
+    monkeypatch.setitem(sys.modules, 'pyarrow', None)
+    assert "Exporting to 'parquet' requires pyarrow" in \
+            run_two_cents('export {} --format parquet'.format(tmpdir))
+
+@pytest.mark.parametrize('format', ['parquet', 'arrow'])
+def test_export_arrow(fresh_test_db, tmpdir, format):
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.ipc, pyarrow.parquet
+
+    with open_test_db() as session:
+        bank, payments, budgets = fill_database(session)
+        payments[0].assign('groceries')
+        payments[1].assign('ignore')
+
+    assert "Exported 2 payments, 2 budgets, and 1 bank to" in \
+            run_two_cents('export {} --format {}'.format(tmpdir, format))
+
+    def read_table(name):
+        path = str(tmpdir.join(name + '.' + format))
+        if format == 'parquet':
+            return pyarrow.parquet.read_table(path).to_pylist()
+        else:
+            return pyarrow.ipc.open_file(path).read_all().to_pylist()
+
+    today = test_dates['today']
+
+    assert read_table('payments') == [
+            dict(id=1, bank='wells_fargo', account_id='0000000000000000', date=today.date(), value=-100.0, budget='groceries', ignored=False, description='description...'),
+            dict(id=2, bank='wells_fargo', account_id='0000000000000000', date=today.date(), value=-10.0, budget=None, ignored=True, description='description...'),
+    ]
+    assert read_table('budgets') == [
+            dict(id=1, name='groceries', balance=-100.0, allowance_per_day=0.0, last_update=today),
+            dict(id=2, name='restaurants', balance=0.0, allowance_per_day=0.0, last_update=today),
+    ]
+    assert read_table('banks') == [
+            dict(id=1, scraper_key='wells_fargo', title='Wells Fargo', last_update=today),
+    ]
+
+def test_import_ofx(fresh_test_db, tmpdir):
+    statement = """\
+OFXHEADER:100
+DATA:OFXSGML
+
+<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS>
+<BANKACCTFROM><ACCTID>1111222233334444</BANKACCTFROM>
+<BANKTRANLIST>
+<STMTTRN><DTPOSTED>20131215<TRNAMT>-12.34<FITID>{}<NAME>SAFEWAY<MEMO>GROCERIES</STMTTRN>
+<STMTTRN><DTPOSTED>20131216<TRNAMT>-5.00<FITID>{}<NAME>CAFE<MEMO>COFFEE</STMTTRN>
+</BANKTRANLIST>
+</STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>
+"""
+    tmpdir.mkdir('2013').join('december.QFX').write(statement.format('txn-1', 'txn-2'))
+    tmpdir.join('january.ofx').write(statement.format('txn-2', 'txn-3'))
+    tmpdir.join('notes.txt').write('not an OFX file')
+
+    assert "No banks to import payments into." in \
+            run_two_cents('import_ofx {}'.format(tmpdir))
+
+    with open_test_db() as session:
+        add_bank(session)
+
+    assert "No such file or directory: 'no-such-file.ofx'" in \
+            run_two_cents('import_ofx no-such-file.ofx')
+    assert "Imported 3 new payments (1 already known)." in \
+            run_two_cents('import_ofx {}'.format(tmpdir))
+    assert "Imported 0 new payments (2 already known)." in \
+            run_two_cents('import_ofx {} --bank wells_fargo'.format(tmpdir.join('january.ofx')))
+
+    with open_test_db() as session:
+        payments = two_cents.get_payments(session)
+        summary = sorted(
+                (x.transaction_id, x.value, x.description) for x in payments)
+
+        assert summary == [
+                ('txn-1', -12.34, 'SAFEWAY GROCERIES'),
+                ('txn-2', -5.00, 'CAFE COFFEE'),
+                ('txn-3', -5.00, 'CAFE COFFEE'),
+        ]
+
 def test_reassign_payments(fresh_test_db):
     with open_test_db() as session:
         bank, payments, budgets = fill_database(session)
@@ -116,6 +235,32 @@ def test_reassign_payments(fresh_test_db):
     with open_test_db() as session:
         assert two_cents.get_payment(session, 1).assignment == 'restaurants'
 
+def test_reassign_many_payments(fresh_test_db):
+    with open_test_db() as session:
+        bank, payments, budgets = fill_database(session)
+        add_payment(bank, -1, 'tomorrow')
+        payments[0].description = 'SAFEWAY'
+
+    assert "Specify which payments to reassign" in \
+            run_two_cents('reassign_payments groceries')
+    assert "No payment with id='42'." in \
+            run_two_cents('reassign_payments groceries 1 42')
+    assert "Expected a date like YYYY-MM-DD or MM/DD/YY, not 'soon'." in \
+            run_two_cents('reassign_payments groceries --since soon')
+
+    assert "Reassigned 2 payments to 'restaurants'." in \
+            run_two_cents('reassign_payments restaurants 1 2')
+    assert "Reassigned 1 payment to 'groceries'." in \
+            run_two_cents('reassign_payments groceries --description safe')
+    assert "Reassigned 1 payment to 'groceries'." in \
+            run_two_cents('reassign_payments groceries 2 3 --until 01/01/14')
+
+    with open_test_db() as session:
+        payments = two_cents.get_payments(session)
+        assert [x.assignment for x in payments] == ['groceries', 'groceries', None]
+        assert two_cents.get_budget(session, 'groceries').balance == -110
+        assert two_cents.get_budget(session, 'restaurants').balance == 0
+
 def test_remove_budget(fresh_test_db):
     with open_test_db() as session:
         fill_database(session)
@@ -126,6 +271,113 @@ def test_remove_budget(fresh_test_db):
     with open_test_db() as session:
         assert not two_cents.budget_exists(session, 'groceries')
 
+def test_rules(fresh_test_db):
+    with open_test_db() as session:
+        bank, payments, budgets = fill_database(session)
+        payments[0].description = 'SAFEWAY'
+        payments[1].description = 'Pizza Place'
+
+    assert "No rules to display." in run_two_cents('show_rules')
+    assert "A rule needs at least one criterion" in \
+            run_two_cents('add_rule groceries')
+    assert "No budget named 'no-such-budget'." in \
+            run_two_cents('add_rule no-such-budget --description safeway')
+
+    run_two_cents('add_rule groceries --description safeway --min 10')
+    run_two_cents('add_rule ignore --max 1 --account 0000')
+    run_two_cents('add_rule restaurants --description pizza')
+
+    assert run_two_cents('show_rules').split() == [
+            '#1', 'groceries', "'safeway'", '>=', '$10.00',
+            '#2', 'ignore', '<=', '$1.00', '****0000',
+            '#3', 'restaurants', "'pizza'",
+    ]
+
+    assert "No rule with id='42'." in run_two_cents('remove_rule 42')
+    run_two_cents('remove_rule 3')
+
+    # The first payment should be assigned automatically, so only the second 
+    # one should need to be assigned by hand.
+
+    run_two_cents('-D', 'restaurants')
+
+    with open_test_db() as session:
+        assert two_cents.get_payment(session, 1).assignment == 'groceries'
+        assert two_cents.get_payment(session, 2).assignment == 'restaurants'
+        assert len(two_cents.get_rules(session)) == 2
+
+def test_serve(fresh_test_db, tmpdir):
+    import os, subprocess, sys, threading
+    from two_cents.server import Server, ServerError, remove_stale_socket
+
+    with open_test_db() as session:
+        fill_database(session)
+
+    # Run the server in this process (so it sees the fake date), and the 
+    # client in its own process (like it would be in real life).
+
+    socket_path = str(tmpdir / 'server.sock')
+    server = Server(socket_path, test_db_path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    def run_client(argv, *stdin, cwd=None):
+        env = dict(os.environ, TWO_CENTS_SOCKET=socket_path)
+        env['PYTHONPATH'] = os.pathsep.join([
+                os.path.dirname(os.path.dirname(two_cents.__file__)),
+                env.get('PYTHONPATH', '')])
+        client = subprocess.run(
+                [sys.executable, '-m', 'two_cents_client'] + argv,
+                input=''.join(x + '\n' for x in stdin),
+                stdout=subprocess.PIPE, universal_newlines=True, env=env, cwd=cwd)
+        return client.returncode, client.stdout
+
+    try:
+        with pytest.raises(ServerError):
+            remove_stale_socket(socket_path)
+
+        assert run_client(['show_allowance']) == \
+                (0, "Groceries          $0.00/mo        \n"
+                    "Restaurants        $0.00/mo        \n")
+        assert run_client(['-D'], 'groceries', 'restaurants')[0] == 0
+        assert "No budget named 'nope'." in run_client(['remove_budget', 'nope'])[1]
+        assert "Usage:" in run_client(['not_a_command'])[1]
+
+        # Relative paths should be relative to the client's working directory, 
+        # not the server's.
+
+        cwd = os.getcwd()
+        tmpdir.mkdir('client')
+        assert "Exported 2 payments" in \
+                run_client(['export', 'out'], cwd=str(tmpdir / 'client'))[1]
+        assert tmpdir.join('client', 'out', 'payments.csv').check()
+        assert not os.path.exists('out')
+        assert os.getcwd() == cwd
+
+        with open_test_db() as session:
+            assert two_cents.get_payment(session, 1).assignment == 'groceries'
+            assert two_cents.get_payment(session, 2).assignment == 'restaurants'
+
+        # Concurrent clients should take turns.
+
+        threads = [
+                threading.Thread(target=run_client, args=(['add_budget', 'budget {}'.format(i)],))
+                for i in range(5)]
+        for x in threads: x.start()
+        for x in threads: x.join()
+
+        with open_test_db() as session:
+            assert two_cents.get_num_budgets(session) == 7
+
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+        two_cents.dispose_engines()
+
+    remove_stale_socket(socket_path)
+    assert not os.path.exists(socket_path)
+
 def test_show_payments(fresh_test_db):
     with open_test_db() as session:
         bank, payments, budgets = fill_database(session)
@@ -163,6 +415,77 @@ Description: SAFEWAY
 
 '''
 
+def test_show_payments_tsv(fresh_test_db):
+    with open_test_db() as session:
+        bank, payments, budgets = fill_database(session)
+        add_payment(bank, -0.5)
+        payments[0].assign('groceries')
+        payments[0].description = 'SAFEWAY  '
+        payments[1].assign('ignore')
+
+    assert run_two_cents('show_payments -1') == '''\
+1\tWells Fargo\t****0000\t2014-01-01\t-100.0\tgroceries\tSAFEWAY
+2\tWells Fargo\t****0000\t2014-01-01\t-10.0\tignore\tdescription...
+3\tWells Fargo\t****0000\t2014-01-01\t-0.5\tNone\tdescription...
+'''
+    assert run_two_cents('show_payments groceries -1') == '''\
+1\tWells Fargo\t****0000\t2014-01-01\t-100.0\tgroceries\tSAFEWAY
+'''
+
+def test_show_payments_in_range(fresh_test_db):
+    with open_test_db() as session:
+        bank, payments, budgets = fill_database(session)
+        add_payment(bank, -1, 'tomorrow')
+        add_payment(bank, -2, 'next week')
+
+    def ids(argv):
+        stdout = run_two_cents('show_payments -1 ' + argv)
+        return [int(line.split('\t')[0]) for line in stdout.splitlines()]
+
+    assert ids('') == [1, 2, 3, 4]
+    assert ids('--limit 3') == [1, 2, 3]
+    assert ids('--since 2014-01-02') == [3, 4]
+    assert ids('--until 01/02/14') == [1, 2, 3]
+    assert ids('--since 2014-01-02 --limit 1') == [3]
+
+    assert "Expected a non-negative number of payments, not 'many'." in \
+            run_two_cents('show_payments --limit many')
+
+def test_suggest_allowance(fresh_test_db):
+    with open_test_db() as session:
+        bank, payments, budgets = fill_database(session)
+        payments[0].assign('groceries')
+        payments[1].assign('restaurants')
+
+    change_date('tomorrow')
+
+    stdout = run_two_cents('suggest_allowance groceries -s')
+    assert stdout.split() == ['Groceries', '$3041.67/mo']
+
+    with open_test_db() as session:
+        groceries = two_cents.get_budget(session, 'groceries')
+        restaurants = two_cents.get_budget(session, 'restaurants')
+
+        assert groceries.pretty_allowance == '$3041.67/mo'
+        assert restaurants.allowance == 0
+
+def test_suggest_assignments(fresh_test_db):
+    with open_test_db() as session:
+        bank, payments, budgets = fill_database(session)
+        payments[0].description = 'SAFEWAY #123'
+        payments[0].assign('groceries')
+        add_payment(bank, -5).description = 'SAFEWAY #456'
+        add_payment(bank, -6).description = 'PIZZA PLACE'
+
+    stdout = run_two_cents('-D', 'skip', '', 'restaurants')
+
+    assert stdout.count("Account [groceries]:") == 1
+    assert stdout.count("Account [") == 1
+
+    with open_test_db() as session:
+        assert two_cents.get_payment(session, 3).assignment == 'groceries'
+        assert two_cents.get_payment(session, 4).assignment == 'restaurants'
+
 def test_transfer_money(fresh_test_db):
     with open_test_db() as session:
         fill_database(session)
@@ -225,4 +548,9 @@ def test_update_budgets(fresh_test_db):
 Groceries           $50.00         
 Restaurants        -$10.00 (4 days)
 '''
+    assert run_two_cents('-D -S balance') == '''\
+Restaurants        -$10.00 (4 days)
+Groceries           $50.00         
+'''
+    assert "Can't sort budgets by 'color'." in run_two_cents('-D -S color')
 
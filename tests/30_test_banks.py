@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+import pytest, datetime, two_cents.banks, two_cents.ofx
+from decimal import Decimal
+from test_helpers import *
+
+def test_wait_for_download(tmpdir):
+    import threading
+    from selenium.common.exceptions import TimeoutException
+
+    def download(name, delay):
+        def write_file():
+            tmpdir.join(name + '.part').write('')
+            tmpdir.join(name).write('')
+            tmpdir.join(name + '.part').remove()
+
+        timer = threading.Timer(delay, write_file)
+        timer.start()
+        return timer
+
+    download('a.qfx', 0.2)
+    paths = two_cents.banks.wait_for_download(str(tmpdir), 1, timeout=5)
+    assert paths == [str(tmpdir.join('a.qfx'))]
+
+    # Files that are still being downloaded shouldn't be counted.
+
+    tmpdir.join('b.qfx').write('')
+    tmpdir.join('b.qfx.part').write('')
+
+    with pytest.raises(TimeoutException):
+        two_cents.banks.wait_for_download(str(tmpdir), 2, timeout=0.3)
+
+    tmpdir.join('b.qfx.part').remove()
+    assert len(two_cents.banks.wait_for_download(str(tmpdir), 2)) == 2
+
+def test_wait_for_account_download(tmpdir, capsys):
+    wait = two_cents.banks.wait_for_account_download
+
+    # Accounts without any activity don't produce a file, which shouldn't stop 
+    # the other accounts from being downloaded.
+
+    assert not wait(str(tmpdir), 1, 'CHECKING XXXX4444', timeout=0.2)
+    assert "Nothing was downloaded for account 'CHECKING XXXX4444'" in \
+            capsys.readouterr().out
+
+    tmpdir.join('a.qfx').write('')
+    assert wait(str(tmpdir), 1, 'SAVINGS XXXX8888', timeout=0.2)
+    assert capsys.readouterr().out == ''
+
+def test_firefox_displays(fresh_test_db, monkeypatch):
+    import os, threading, xvfbwrapper
+
+    # Pretend to start Xvfb the way xvfbwrapper does, i.e. by setting $DISPLAY 
+    # in whatever environment it was given, and make sure that each browser 
+    # gets its own display even when several are started at once.
+
+    displays = iter(range(100, 200))
+    barrier = threading.Barrier(2, timeout=5)
+
+    class FakeXvfb:
+
+        def __init__(self, environ=None):
+            self.environ = os.environ if environ is None else environ
+            self.orig_display = self.environ.get('DISPLAY')
+
+        def start(self):
+            self.new_display = next(displays)
+            self.environ['DISPLAY'] = ':{}'.format(self.new_display)
+
+        def stop(self):
+            self.environ.pop('DISPLAY', None)
+            if self.orig_display is not None:
+                self.environ['DISPLAY'] = self.orig_display
+
+    class FakeFirefox:
+
+        def __init__(self, profile, capabilities=None, options=None):
+            self.arguments = options.arguments
+            self.environ_display = os.environ.get('DISPLAY')
+            barrier.wait()
+
+        def implicitly_wait(self, timeout):
+            pass
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(xvfbwrapper, 'Xvfb', FakeXvfb)
+    monkeypatch.setattr(two_cents.banks.webdriver, 'Firefox', FakeFirefox)
+    monkeypatch.setattr(BrowserScraper, 'drivers', [])
+    monkeypatch.setenv('DISPLAY', ':0')
+
+    keys = 'browser_bank_1', 'browser_bank_2'
+    for key in keys:
+        two_cents.register_scraper(key, key, 'test_helpers:BrowserScraper')
+
+    try:
+        with open_test_db() as session:
+            for key in keys:
+                bank = add_bank(session, key)
+                bank.username_command = 'echo username'
+                bank.password_command = 'echo password'
+
+            two_cents.download_payments(session, None, None, workers=2)
+    finally:
+        for key in keys:
+            del two_cents.scrapers[key]
+
+    arguments = sorted(x.arguments for x in BrowserScraper.drivers)
+    assert arguments == [['--display=:100'], ['--display=:101']]
+    assert all(x.environ_display == ':0' for x in BrowserScraper.drivers)
+    assert os.environ['DISPLAY'] == ':0'
+
+def test_direct_connect():
+    import re, threading
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+    header = '''\
+OFXHEADER:100
+DATA:OFXSGML
+VERSION:102
+SECURITY:NONE
+ENCODING:USASCII
+CHARSET:1252
+COMPRESSION:NONE
+OLDFILEUID:NONE
+NEWFILEUID:NONE
+
+<OFX><SIGNONMSGSRSV1><SONRS><STATUS><CODE>0<SEVERITY>INFO</STATUS><DTSERVER>20140101<LANGUAGE>ENG</SONRS></SIGNONMSGSRSV1>'''
+
+    account_info = header + '''\
+<SIGNUPMSGSRSV1><ACCTINFOTRNRS><TRNUID>1<STATUS><CODE>0<SEVERITY>INFO</STATUS><ACCTINFORS><DTACCTUP>20140101
+<ACCTINFO><BANKACCTINFO><BANKACCTFROM><BANKID>121000248<ACCTID>1111222233334444<ACCTTYPE>CHECKING</BANKACCTFROM><SUPTXDL>Y<XFERSRC>Y<XFERDEST>Y<SVCSTATUS>ACTIVE</BANKACCTINFO></ACCTINFO>
+<ACCTINFO><CCACCTINFO><CCACCTFROM><ACCTID>5555666677778888</CCACCTFROM><SUPTXDL>Y<XFERSRC>N<XFERDEST>N<SVCSTATUS>ACTIVE</CCACCTINFO></ACCTINFO>
+</ACCTINFORS></ACCTINFOTRNRS></SIGNUPMSGSRSV1></OFX>'''
+
+    bank_statement = header + '''\
+<BANKMSGSRSV1><STMTTRNRS><TRNUID>2<STATUS><CODE>0<SEVERITY>INFO</STATUS><STMTRS><CURDEF>USD
+<BANKACCTFROM><BANKID>121000248<ACCTID>1111222233334444<ACCTTYPE>CHECKING</BANKACCTFROM>
+<BANKTRANLIST><DTSTART>20131201<DTEND>20140101
+<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20131215120000.000<TRNAMT>-12.34<FITID>txn-1<NAME>SAFEWAY<MEMO>GROCERIES</STMTTRN>
+<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20131220120000.000<TRNAMT>1000.00<FITID>txn-2<NAME>PAYCHECK<MEMO></STMTTRN>
+</BANKTRANLIST><LEDGERBAL><BALAMT>987.66<DTASOF>20140101</LEDGERBAL></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>'''
+
+    card_statement = header + '''\
+<CREDITCARDMSGSRSV1><CCSTMTTRNRS><TRNUID>3<STATUS><CODE>0<SEVERITY>INFO</STATUS><CCSTMTRS><CURDEF>USD
+<CCACCTFROM><ACCTID>5555666677778888</CCACCTFROM>
+<BANKTRANLIST><DTSTART>20131201<DTEND>20140101
+<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20131225<TRNAMT>-50.00<FITID>txn-3<NAME>BOOKSTORE<MEMO>GIFTS</STMTTRN>
+</BANKTRANLIST><LEDGERBAL><BALAMT>-50.00<DTASOF>20140101</LEDGERBAL></CCSTMTRS></CCSTMTTRNRS></CREDITCARDMSGSRSV1></OFX>'''
+
+    requests = []
+    connections = []
+
+    class StubOfxServer (BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            connections.append(self.client_address)
+
+        def do_POST(self):
+            request = self.rfile.read(int(self.headers['Content-Length']))
+            request = request.decode('cp1252')
+            requests.append(request)
+
+            if '<USERPASS>wrong' in request:
+                response = header.replace(
+                        '<CODE>0<SEVERITY>INFO',
+                        '<CODE>15500<SEVERITY>ERROR<MESSAGE>Bad password')
+            elif '<ACCTINFORQ>' in request:
+                response = account_info
+            elif '<CCSTMTRQ>' in request:
+                response = card_statement
+            else:
+                response = bank_statement
+
+            response = response.encode('cp1252')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ofx')
+            self.send_header('Content-Length', str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), StubOfxServer)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        url = 'http://127.0.0.1:{}/ofx'.format(server.server_port)
+        scraper = two_cents.ofx.DirectConnect(
+                'username', 'password', url=url, org='ORG', fid='1234')
+        accounts = scraper.download(test_dates['today'] - datetime.timedelta(31))
+
+        # All three requests should be made over the same connection.
+
+        assert len(requests) == 3
+        assert len(connections) == 1
+        assert '<USERID>username' in requests[0]
+        assert '<FID>1234' in requests[0]
+        assert '<DTSTART>20131201' in requests[1]
+        assert '<ACCTID>1111222233334444' in requests[1]
+        assert '<ACCTID>5555666677778888' in requests[2]
+
+        transactions = list(two_cents.iter_transactions(accounts))
+        summary = [
+                (number, x.id, x.date.date(), x.amount, x.payee, x.memo)
+                for number, x in transactions
+        ]
+        assert summary == [
+                ('1111222233334444', 'txn-1', datetime.date(2013, 12, 15),
+                    Decimal('-12.34'), 'SAFEWAY', 'GROCERIES'),
+                ('1111222233334444', 'txn-2', datetime.date(2013, 12, 20),
+                    Decimal('1000.00'), 'PAYCHECK', ''),
+                ('5555666677778888', 'txn-3', datetime.date(2013, 12, 25),
+                    Decimal('-50.00'), 'BOOKSTORE', 'GIFTS'),
+        ]
+
+        with pytest.raises(two_cents.ofx.OfxError):
+            scraper = two_cents.ofx.DirectConnect(
+                    'username', 'wrong', url=url, org='ORG', fid='1234')
+            scraper.download()
+
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_parse_ofx():
+    import io
+
+    sgml = b'''\
+OFXHEADER:100
+DATA:OFXSGML
+VERSION:102
+ENCODING:USASCII
+CHARSET:1252
+
+<OFX>
+<BANKMSGSRSV1><STMTTRNRS><STMTRS>
+<BANKACCTFROM><BANKID>121000248<ACCTID>1111222233334444<ACCTTYPE>CHECKING</BANKACCTFROM>
+<BANKTRANLIST>
+<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20131215120000.000[-8:PST]<TRNAMT>-12.34<FITID>txn-1<NAME>AT&amp;T<MEMO>PHONE BILL \xe9</STMTTRN>
+<STMTTRN><TRNTYPE>XFER<DTPOSTED>20131216<TRNAMT>-100,00<FITID>txn-2<NAME>TRANSFER
+<BANKACCTTO><BANKID>121000248<ACCTID>9999999999999999<ACCTTYPE>SAVINGS</BANKACCTTO>
+</STMTTRN>
+</BANKTRANLIST>
+</STMTRS></STMTTRNRS></BANKMSGSRSV1>
+<CREDITCARDMSGSRSV1><CCSTMTTRNRS><CCSTMTRS>
+<CCACCTFROM><ACCTID>5555666677778888</CCACCTFROM>
+<BANKTRANLIST>
+<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20131225<TRNAMT>-50.00<FITID>txn-3<NAME>BOOKSTORE<MEMO>GIFTS</STMTTRN>
+</BANKTRANLIST>
+</CCSTMTRS></CCSTMTTRNRS></CREDITCARDMSGSRSV1>
+</OFX>
+'''
+    xml = '''\
+<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<?OFX OFXHEADER="200" VERSION="211" SECURITY="NONE"?>
+<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS>
+<BANKACCTFROM><BANKID>121000248</BANKID><ACCTID>1111222233334444</ACCTID><ACCTTYPE>CHECKING</ACCTTYPE></BANKACCTFROM>
+<BANKTRANLIST>
+<STMTTRN><TRNTYPE>DEBIT</TRNTYPE><DTPOSTED>20131215120000</DTPOSTED><TRNAMT>-12.34</TRNAMT><FITID>txn-1</FITID><NAME>AT&amp;T</NAME><MEMO>PHONE BILL \xe9</MEMO></STMTTRN>
+</BANKTRANLIST>
+</STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>
+'''.encode('utf-8')
+
+    def summarize(ofx_file, chunk_size):
+        return [
+                (number, x.id, x.date, x.amount, x.payee, x.memo)
+                for number, x in two_cents.ofx.iter_transactions(
+                    io.BytesIO(ofx_file), chunk_size)
+        ]
+
+    phone_bill = ('1111222233334444', 'txn-1',
+            datetime.datetime(2013, 12, 15, 12), Decimal('-12.34'),
+            'AT&T', 'PHONE BILL \xe9')
+
+    # Use small chunks to make sure that tags split between chunks are 
+    # handled properly.
+
+    for chunk_size in 7, 64, 65536:
+        assert summarize(sgml, chunk_size) == [
+                phone_bill,
+                ('1111222233334444', 'txn-2',
+                    datetime.datetime(2013, 12, 16), Decimal('-100.00'),
+                    'TRANSFER', ''),
+                ('5555666677778888', 'txn-3',
+                    datetime.datetime(2013, 12, 25), Decimal('-50.00'),
+                    'BOOKSTORE', 'GIFTS'),
+        ]
+        assert summarize(xml, chunk_size) == [phone_bill]
+
+    accounts = two_cents.ofx.parse(io.BytesIO(sgml))
+
+    assert [x.number for x in accounts] == [
+            '1111222233334444', '5555666677778888']
+    assert [len(x.statement.transactions) for x in accounts] == [2, 1]
+
+def test_parse_ofx_transactions():
+    import io
+
+    def parse(transactions):
+        ofx_file = io.BytesIO('''\
+OFXHEADER:100
+DATA:OFXSGML
+
+<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS>
+<BANKACCTFROM><ACCTID>1111222233334444</BANKACCTFROM>
+<BANKTRANLIST>
+{}
+</BANKTRANLIST>
+</STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>
+'''.format(transactions).encode('ascii'))
+        return [x.amount for n, x in two_cents.ofx.iter_transactions(ofx_file)]
+
+    assert parse('''\
+<STMTTRN><DTPOSTED>20131215<TRNAMT>1,000.00<FITID>txn-1</STMTTRN>
+<STMTTRN><DTPOSTED>20131215<TRNAMT>-1.000,00<FITID>txn-2</STMTTRN>
+<STMTTRN><DTPOSTED>20131215<TRNAMT>-12,34<FITID>txn-3</STMTTRN>
+<STMTTRN><DTPOSTED>20131215<TRNAMT>-12.34<FITID>txn-4</STMTTRN>
+''') == [
+            Decimal('1000.00'), Decimal('-1000.00'),
+            Decimal('-12.34'), Decimal('-12.34')]
+
+    with pytest.raises(two_cents.ofx.OfxError, match="'txn-1' has no date"):
+        parse('<STMTTRN><TRNAMT>-1.00<FITID>txn-1</STMTTRN>')
+    with pytest.raises(two_cents.ofx.OfxError, match="'txn-1' has an invalid date"):
+        parse('<STMTTRN><DTPOSTED>UNKNOWN<TRNAMT>-1.00<FITID>txn-1</STMTTRN>')
+    with pytest.raises(two_cents.ofx.OfxError, match="'txn-1' has an invalid amount"):
+        parse('<STMTTRN><DTPOSTED>20131215<TRNAMT>1.0.0<FITID>txn-1</STMTTRN>')
+
+def test_parse_ofx_files(tmpdir, monkeypatch):
+    statement = '''\
+OFXHEADER:100
+DATA:OFXSGML
+
+<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS>
+<BANKACCTFROM><ACCTID>{0}</BANKACCTFROM>
+<BANKTRANLIST>
+<STMTTRN><DTPOSTED>20131215<TRNAMT>-1.00<FITID>{1}<NAME>PAYEE</STMTTRN>
+<STMTTRN><DTPOSTED>20131216<TRNAMT>-2.00<FITID>{2}<NAME>PAYEE</STMTTRN>
+</BANKTRANLIST>
+</STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>
+'''
+    tmpdir.join('c.qfx').write(statement.format('1111', 'txn-5', 'txn-6'))
+    tmpdir.join('a.qfx').write(statement.format('1111', 'txn-1', 'txn-2'))
+    tmpdir.join('b.qfx').write(statement.format('2222', 'txn-3', 'txn-4'))
+
+    paths = [str(x) for x in tmpdir.listdir()]
+
+    def summarize(accounts):
+        return [
+                (x.number, [y.id for y in x.statement.transactions])
+                for x in accounts
+        ]
+
+    for workers in 1, 2, None:
+        accounts = two_cents.ofx.parse_files(paths, workers)
+        assert summarize(accounts) == [
+                ('1111', ['txn-1', 'txn-2', 'txn-5', 'txn-6']),
+                ('2222', ['txn-3', 'txn-4']),
+        ]
+
+    # By default, there shouldn't be more workers than files, and the workers 
+    # shouldn't be forked from this (possibly multi-threaded) process.
+
+    import concurrent.futures, os
+    pools = []
+
+    class RecordingPool (concurrent.futures.ProcessPoolExecutor):
+        def __init__(self, max_workers, mp_context):
+            pools.append((max_workers, mp_context.get_start_method()))
+            super().__init__(max_workers, mp_context)
+
+    monkeypatch.setattr(concurrent.futures, 'ProcessPoolExecutor', RecordingPool)
+    monkeypatch.setattr(os, 'cpu_count', lambda: 64)
+    two_cents.ofx.parse_files(paths)
+
+    assert pools == [(3, 'forkserver')]
+
@@ -15,11 +15,45 @@ test_dates = {
 
 @pytest.fixture
 def fresh_test_db():
-    from os import remove
-    try: remove(test_db_path)
-    except FileNotFoundError: pass
+    remove_test_db()
     change_date('today')
 
+def remove_test_db():
+    from os import remove
+    for path in (test_db_path, test_db_path + '-wal', test_db_path + '-shm'):
+        try: remove(path)
+        except FileNotFoundError: pass
+
+def make_legacy_test_db(payments=(), budgets=()):
+    """
+    Create a test database with the schema used by two_cents 1.0, which 
+    stored money as floats and assigned payments to budgets by name.
+    """
+    import sqlite3
+    db = sqlite3.connect(test_db_path)
+    db.executescript("""
+        CREATE TABLE budgets (
+            id INTEGER NOT NULL, name VARCHAR NOT NULL, balance FLOAT NOT NULL,
+            allowance FLOAT NOT NULL, last_update DATETIME NOT NULL,
+            PRIMARY KEY (id), UNIQUE (name));
+        CREATE TABLE banks (
+            id INTEGER NOT NULL, scraper_key VARCHAR NOT NULL,
+            username_command VARCHAR, password_command VARCHAR,
+            last_update DATETIME, PRIMARY KEY (id), UNIQUE (scraper_key));
+        CREATE TABLE payments (
+            id INTEGER NOT NULL, bank_id INTEGER, account_id VARCHAR,
+            transaction_id VARCHAR, date DATE NOT NULL, value FLOAT NOT NULL,
+            description TEXT, assignment VARCHAR, PRIMARY KEY (id),
+            FOREIGN KEY(bank_id) REFERENCES banks (id));
+        INSERT INTO banks VALUES (1, 'wells_fargo', NULL, NULL, '2014-01-01 00:00:00.000000');
+    """)
+    for name, balance, allowance in budgets:
+        db.execute("INSERT INTO budgets (name, balance, allowance, last_update) VALUES (?, ?, ?, '2014-01-01 00:00:00.000000')", (name, balance, allowance))
+    for i, (value, assignment) in enumerate(payments):
+        db.execute("INSERT INTO payments (bank_id, account_id, transaction_id, date, value, description, assignment) VALUES (1, '0000000000000000', ?, '2014-01-01', ?, 'description...', ?)", ('transaction id {}'.format(i), value, assignment))
+    db.commit()
+    db.close()
+
 def open_test_db():
     return two_cents.open_db(test_db_path)
 
@@ -46,7 +80,10 @@ def add_bank(session, scraper_key='wells_fargo'):
     return bank
 
 def add_payment(bank, value=-100, date='today'):
-    payment = two_cents.Payment('0000000000000000', 'transaction id', test_dates[date].date(), value, 'description...')
+    # Each payment needs a unique transaction id, because the database won't 
+    # record the same transaction twice.
+    txn_id = 'transaction id {}'.format(len(bank.payments))
+    payment = two_cents.Payment('0000000000000000', txn_id, test_dates[date].date(), value, 'description...')
     bank.payments.append(payment)
     return payment
 
@@ -56,3 +93,83 @@ def add_budget(session, name, balance=0, allowance=''):
     return budget
 
 
+
+def add_transaction(account, id, value=-100, date='today', payee='PAYEE', memo='MEMO'):
+    from types import SimpleNamespace
+    transaction = SimpleNamespace(
+            id=id, date=test_dates[date], amount=value, payee=payee, memo=memo)
+    account.statement.transactions.append(transaction)
+    return transaction
+
+
+class FakeScraper:
+    """
+    Pretend to download transactions from a bank, so that the code that 
+    records those transactions in the database can be tested without a 
+    browser or a network connection.
+    """
+    accounts = []
+    downloads = []
+
+    def __init__(self, username, password, gui=False):
+        pass
+
+    def download(self, from_date=None, to_date=None, account_dates=None):
+        self.downloads.append((from_date, account_dates))
+        return self.accounts
+
+    @classmethod
+    def add_account(cls, number):
+        from types import SimpleNamespace
+        account = SimpleNamespace(
+                number=number, statement=SimpleNamespace(transactions=[]))
+        cls.accounts.append(account)
+        return account
+
+
+class LegacyScraper (FakeScraper):
+    """
+    Pretend to be a scraper written before per-account download windows 
+    existed (e.g. a plugin), which only accepts a start date.
+    """
+
+    def download(self, from_date):
+        self.downloads.append((from_date, None))
+        return self.accounts
+
+
+class BrowserScraper:
+    """
+    Pretend to scrape a bank's website, so that the code that sets up the 
+    browser can be tested without Firefox or Xvfb.  The tests are expected to 
+    replace those with fakes that record what display each browser uses.
+    """
+    drivers = []
+
+    def __init__(self, username, password, gui=False):
+        pass
+
+    def download(self, from_date=None, to_date=None):
+        import tempfile
+        from two_cents.banks import firefox_driver
+
+        with tempfile.TemporaryDirectory() as dir:
+            with firefox_driver(dir) as driver:
+                self.drivers.append(driver)
+        return []
+
+
+@pytest.fixture
+def fake_scraper():
+    two_cents.register_scraper(
+            'fake_bank', 'Fake Bank', 'test_helpers:FakeScraper')
+    FakeScraper.accounts = []
+    FakeScraper.downloads = []
+    yield FakeScraper
+    del two_cents.scrapers['fake_bank']
+
+def download_fake_payments(session):
+    bank = two_cents.get_bank(session, 'fake_bank')
+    bank.username_command = 'echo username'
+    bank.password_command = 'echo password'
+    return bank.download_payments(None, None)
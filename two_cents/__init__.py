@@ -2,6 +2,6 @@
 
 __version__ = '1.0.1'
 
-from . import banks, cli
+from . import cli
 from .model import *
 
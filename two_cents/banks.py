@@ -4,23 +4,28 @@ import appdirs
 import contextlib
 import datetime
 import itertools
-import ofxparse
 import os
 import pathlib
 import tempfile
 import time
-import warnings
 
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
+from selenium.webdriver.firefox.options import Options as FirefoxOptions
 from selenium.webdriver.support.ui import Select, WebDriverWait
 from selenium.webdriver.support.expected_conditions import staleness_of, element_to_be_clickable
-from selenium.common.exceptions import NoSuchElementException
+from selenium.common.exceptions import NoSuchElementException, TimeoutException
+
+from . import ofx
 
 dirs = appdirs.AppDirs('two_cents', 'username')
 
+# How often (in seconds) to check whether the page is ready while waiting for 
+# something to happen in the browser.
+poll_frequency = 0.1
+
 # Debug Mode
 # ==========
 # 1. Show GUI
@@ -32,11 +37,19 @@ def firefox_driver(download_dir, gui=False, max_load_time=30):
     from xvfbwrapper import Xvfb
 
     # If the GUI was not explicitly requested, use the X virtual frame buffer 
-    # (Xvfb) to gobble it.
+    # (Xvfb) to gobble it.  Several banks can be scraped at once (each in its 
+    # own thread), so each browser gets its own display.  Xvfb would normally 
+    # set $DISPLAY for the whole process, which would let the threads steal 
+    # each other's displays, so give it a private copy of the environment and 
+    # tell Firefox which display to use on the command line instead.
+
+    options = FirefoxOptions()
+    driver = None
 
     if not gui:
-        xvfb = Xvfb()
+        xvfb = Xvfb(environ=dict(os.environ))
         xvfb.start()
+        options.add_argument('--display=:{}'.format(xvfb.new_display))
 
     try:
 
@@ -68,7 +81,7 @@ def firefox_driver(download_dir, gui=False, max_load_time=30):
 
         # Construct and yield a Firefox driver.
 
-        driver = webdriver.Firefox(profile, capabilities=capabilities)
+        driver = webdriver.Firefox(profile, capabilities=capabilities, options=options)
         driver.implicitly_wait(max_load_time)
 
         yield driver
@@ -79,23 +92,86 @@ def firefox_driver(download_dir, gui=False, max_load_time=30):
         # complete.
 
         if not gui:
-            driver.close()
+            if driver is not None:
+                driver.close()
             xvfb.stop()
 
 def wait_for_element(driver, element_type, element_identifier, timeout=30):
-    wait = WebDriverWait(driver, timeout)
-    wait.until(element_to_be_clickable((element_type, element_identifier)))
-
-    # It shouldn't be necessary to manually sleep here, and I suspect that it 
-    # only is necessary because of a bug in the Marionette driver.  For one 
-    # thing, the line just above is supposed to wait until the relevant element 
-    # is clickable.  For another, the driver has an implicit wait set anyways, 
-    # so it should wait for a few seconds for elements to load.  But despite 
-    # that, immediately calling click() on the element returned by this method 
-    # does nothing.
-    time.sleep(1)
-
-    return driver.find_element(element_type, element_identifier)
+    wait = WebDriverWait(driver, timeout, poll_frequency=poll_frequency)
+
+    # Waiting for the element to be clickable isn't always enough.  Marionette 
+    # seems to report elements as clickable before the page has finished 
+    # loading, and clicks made at that point are silently dropped.  (This used 
+    # to be worked around by sleeping for a second after every wait.)  So also 
+    # wait for the document itself to be ready.
+
+    element = wait.until(element_to_be_clickable((element_type, element_identifier)))
+    wait.until(document_is_ready)
+    return element
+
+def wait_for_staleness(driver, element, timeout=30):
+    """
+    Wait for the given element to be removed from the DOM, which is a reliable 
+    sign that the page has been reloaded (e.g. after submitting a form).
+    """
+    wait = WebDriverWait(driver, timeout, poll_frequency=poll_frequency)
+    wait.until(staleness_of(element))
+
+def wait_for_download(download_dir, num_files, timeout=30):
+    """
+    Wait until the given directory contains the given number of completely 
+    downloaded files, and return the paths to those files.
+
+    Firefox writes each download to a '*.part' file while it's in progress, so 
+    any file with that extension (or with a corresponding '*.part' file) is 
+    not counted.
+    """
+    def finished_downloads():
+        names = set(os.listdir(download_dir))
+        paths = sorted(
+                os.path.join(download_dir, x) for x in names
+                if not x.endswith('.part') and x + '.part' not in names)
+        return paths if len(paths) >= num_files else None
+
+    message = "Timed out waiting for {} file(s) to be downloaded to '{}'."
+    return poll(finished_downloads, timeout,
+            message.format(num_files, download_dir))
+
+def wait_for_account_download(download_dir, num_files, account, timeout=30):
+    """
+    Wait for the given account's activity to be downloaded (see 
+    wait_for_download()), and return true if it was.
+
+    No file is downloaded for accounts that didn't have any activity in the 
+    requested date range, so that's not treated as an error.  Instead, a 
+    warning is printed and false is returned, so that the other accounts can 
+    still be downloaded.
+    """
+    try:
+        wait_for_download(download_dir, num_files, timeout)
+        return True
+    except TimeoutException:
+        print("Nothing was downloaded for account '{}', skipping it.".format(account))
+        return False
+
+def poll(condition, timeout=30, message=''):
+    """
+    Repeatedly call the given function until it returns something truthy, then 
+    return that value.  Raise a TimeoutException if the function doesn't 
+    succeed within the given number of seconds.
+    """
+    end_time = time.monotonic() + timeout
+
+    while True:
+        value = condition()
+        if value:
+            return value
+        if time.monotonic() > end_time:
+            raise TimeoutException(message)
+        time.sleep(poll_frequency)
+
+def document_is_ready(driver):
+    return driver.execute_script('return document.readyState') == 'complete'
 
 def wait_for_element_by_id(driver, id, timeout=30):
     return wait_for_element(driver, By.ID, id, timeout)
@@ -115,12 +191,17 @@ def wait_for_element_by_css_selector(driver, css_selector, timeout=30):
 
 class WellsFargo:
 
-    def __init__(self, username, password, gui=False):
+    def __init__(self, username, password, gui=False, timeout=30):
         self.username = username
         self.password = password
         self.gui = gui
+        self.timeout = timeout
+
+    def download(self, from_date=None, to_date=None, account_dates=None):
+        # The website doesn't identify accounts by number until after they've 
+        # been downloaded, so every account has to be downloaded starting from 
+        # from_date and account_dates is ignored.
 
-    def download(self, from_date=None, to_date=None):
         # Create a temporary directory that the scraper can download all the 
         # financial data into.
         with tempfile.TemporaryDirectory(prefix='two_cents_') as ofx_dir:
@@ -137,65 +218,62 @@ class WellsFargo:
         from_date = from_date.strftime('%m/%d/%y')
         to_date = to_date.strftime('%m/%d/%y')
 
-        with firefox_driver(ofx_dir, gui=self.gui) as driver:
+        with firefox_driver(ofx_dir, gui=self.gui, max_load_time=self.timeout) as driver:
 
             # Login to Wells Fargo's website.
             driver.get('https://www.wellsfargo.com/')
-            username_form = wait_for_element_by_id(driver, 'userid')
-            password_form = wait_for_element_by_id(driver, 'password')
+            username_form = wait_for_element_by_id(driver, 'userid', self.timeout)
+            password_form = wait_for_element_by_id(driver, 'password', self.timeout)
             username_form.send_keys(self.username)
             password_form.send_keys(self.password)
             password_form.submit()
 
-            # Open the "More" menu.
-            time.sleep(5)
-            more = wait_for_element_by_partial_link_text(driver, 'More')
+            # Open the "More" menu once the account summary page has replaced 
+            # the login page.
+            wait_for_staleness(driver, password_form, self.timeout)
+            more = wait_for_element_by_partial_link_text(driver, 'More', self.timeout)
             more.click()
 
             # Navigate to the "Download Your Account Activity" page.
-            wait_for_element_by_partial_link_text(driver, 'Accounts and Settings').click()
-            wait_for_element_by_partial_link_text(driver, 'Account Services').click()
-            wait_for_element_by_partial_link_text(driver, 'Account Management').click()
-            wait_for_element_by_partial_link_text(driver, 'Download Account Activity').click()
+            wait_for_element_by_partial_link_text(driver, 'Accounts and Settings', self.timeout).click()
+            wait_for_element_by_partial_link_text(driver, 'Account Services', self.timeout).click()
+            wait_for_element_by_partial_link_text(driver, 'Account Management', self.timeout).click()
+            wait_for_element_by_partial_link_text(driver, 'Download Account Activity', self.timeout).click()
 
             # Download account activity in the OFX format.
+            num_files = 0
+
             for i in itertools.count():
 
                 # Pick the next account to download.
-                accounts = wait_for_element_by_name(driver, 'primaryKey')
+                accounts = wait_for_element_by_name(driver, 'primaryKey', self.timeout)
                 try: account = Select(accounts).options[i]
                 except IndexError: break
+                account_name = account.text
                 driver.execute_script("arguments[0].selected = true", account)
                 driver.execute_script('arguments[0].click()', driver.find_element_by_id("clickSubmit"))
 
-                # Not totally sure why this is necessary, but without it only 
-                # the first account in the dropdown box is downloaded.
-                time.sleep(1)
+                # Selecting an account reloads the page.  If the date range is 
+                # filled in before that happens, only the first account in the 
+                # dropdown box ends up being downloaded.
+                wait_for_staleness(driver, accounts, self.timeout)
 
                 # Pick the date range to download.
-                driver.find_element_by_id('toDate').clear()
-                driver.find_element_by_id('fromDate').clear()
+                wait_for_element_by_id(driver, 'toDate', self.timeout).clear()
+                wait_for_element_by_id(driver, 'fromDate', self.timeout).clear()
                 driver.find_element_by_id('toDate').send_keys(to_date)
                 driver.find_element_by_id('fromDate').send_keys(from_date)
 
-                # Download it.
+                # Download it, and wait for the file to appear before moving on 
+                # to the next account.
                 driver.find_element_by_id('quickenOFX').click()
                 driver.find_element_by_name('Download').click()
-
-                time.sleep(1)
+                if wait_for_account_download(ofx_dir, num_files + 1, account_name, self.timeout):
+                    num_files += 1
 
     def _parse(self, ofx_dir):
-        accounts = []
-
-        for ofx_path in os.listdir(ofx_dir):
-            ofx_path = os.path.join(ofx_dir, ofx_path)
-            with open(ofx_path, 'rb') as ofx_file:
-                with warnings.catch_warnings():
-                    warnings.simplefilter("ignore")
-                    ofx = ofxparse.OfxParser.parse(ofx_file)
-                accounts += ofx.accounts
-
-        return accounts
+        paths = [os.path.join(ofx_dir, x) for x in os.listdir(ofx_dir)]
+        return ofx.parse_files(paths)
 
 
 class ScrapingError:
@@ -4,18 +4,25 @@
 Maintain a budget that updates every day.
 
 Usage:
-    two_cents [-d] [-D] [-I] [-g] [-h] [-v]
+    two_cents [-d] [-D] [-I] [-g] [-j <workers>] [-S <key>] [-h] [-v]
     two_cents add_bank <name> [-u <command>] [-p <command>]
     two_cents add_budget <name> [-b <dollars>] [-a <dollars-per-time>]
+    two_cents add_rule <budget> [--description <pattern>] [--min <dollars>] [--max <dollars>] [--account <digits>]
     two_cents debug_bank_scraper
     two_cents describe_budgets [-e]
-    two_cents download_payments [-I]
+    two_cents download_payments [-I] [-j <workers>]
+    two_cents export <directory> [<budgets>...] [--format <format>] [--since <date>] [--until <date>]
+    two_cents import_ofx <paths>... [--bank <name>]
     two_cents reassign_payment <payment-id> <budget>
+    two_cents reassign_payments <budget> [<payment-ids>...] [--description <pattern>] [--since <date>] [--until <date>]
     two_cents remove_budget <budget>
+    two_cents remove_rule <rule-id>
     two_cents rename_budget <old_name> <new_name>
+    two_cents serve [--socket <path>]
     two_cents set_allowance <budget> <allowance>
     two_cents show_allowance [<budgets>...]
-    two_cents show_payments [<budget>] [-1]
+    two_cents show_rules
+    two_cents show_payments [<budget>] [-1] [--since <date>] [--until <date>] [--limit <num>]
     two_cents suggest_allowance [<budgets>...] [-s]
     two_cents transfer_allowance <dollars-per-time> <budget-from> <budget-to>
     two_cents transfer_money <dollars> <budget-from> <budget-to>
@@ -61,10 +68,60 @@ Options:
         Indicate that you want to create or update a description of your 
         budgeting scheme.
 
+  -j, --jobs <workers>
+        Download transactions from at most this many banks at once.  By 
+        default, every bank is downloaded at the same time (each in its own 
+        browser).
+
+  --bank <name>
+        When importing OFX files, specify which bank the transactions came 
+        from.  This is only necessary if more than one bank has been added.
+
+  --format <format>
+        When exporting, write files in the given format: 'csv', 'parquet', or 
+        'arrow'.  The latter two require pyarrow to be installed.  
+        [default: csv]
+
+  --description <pattern>
+        When reassigning payments or adding rules, only match payments with 
+        descriptions that contain the given text (ignoring case).  When 
+        reassigning payments, '%' can be used as a wildcard.
+
+  --min <dollars>
+        When adding a rule, only match payments of at least this amount 
+        (ignoring whether the payment is a debit or a credit).
+
+  --max <dollars>
+        When adding a rule, only match payments of at most this amount.
+
+  --account <digits>
+        When adding a rule, only match payments from accounts with numbers 
+        that end with the given digits.
+
+  --since <date>
+        Only consider payments made on or after the given date (e.g. 
+        2014-01-31 or 01/31/14).
+
+  --until <date>
+        Only consider payments made on or before the given date.
+
   -g, --gui
         When downloading new transaction data, show the Firefox GUI so you can 
         watch the scraper work.  This is only useful for debugging.
 
+  -S, --sort <key>
+        When showing budgets, sort them by 'name', 'balance', or 'allowance'.  
+        By default, budgets are shown in the order they were created.
+
+  --limit <num>
+        Show at most this many payments.
+
+  --socket <path>
+        When serving, listen for commands on the Unix socket at the given 
+        path.  By default, the socket is created in the same directory as the 
+        database (or at $TWO_CENTS_SOCKET, if that is set).  The 
+        two_cents_client command forwards its arguments to this socket.
+
   -1, --one-line
         Summarize each payment on one line, to make automated processing 
         easier.  The fields describing each payment will be separated by tabs, 
@@ -84,7 +141,7 @@ from pprint import pprint
 
 dirs = appdirs.AppDirs('two_cents', 'username')
 
-def main(argv=None, db_path=None):
+def main(argv=None, db_path=None, persistent=False):
     try:
         import docopt
         args = docopt.docopt(__doc__, argv)
@@ -97,7 +154,11 @@ def main(argv=None, db_path=None):
             import os
             db_path = os.path.join(dirs.user_config_dir, 'budgets.db')
 
-        with two_cents.open_db(db_path) as session:
+        if args['serve']:
+            serve(db_path, args['--socket'])
+            return
+
+        with two_cents.open_db(db_path, persistent=persistent) as session:
             if args['add_bank']:
                 add_bank(
                         session,
@@ -112,6 +173,15 @@ def main(argv=None, db_path=None):
                         initial_balance=args['--initial-balance'],
                         initial_allowance=args['--initial-allowance'],
                 )
+            elif args['add_rule']:
+                add_rule(
+                        session,
+                        args['<budget>'],
+                        pattern=args['--description'],
+                        min_amount=args['--min'],
+                        max_amount=args['--max'],
+                        account=args['--account'],
+                )
             elif args['describe_budgets']:
                 describe_budgets(
                         edit=args['--edit'],
@@ -125,6 +195,22 @@ def main(argv=None, db_path=None):
                 download_payments(
                         session,
                         interactive=not args['--no-interaction'],
+                        workers=parse_workers(args['--jobs']),
+                )
+            elif args['export']:
+                export(
+                        session,
+                        args['<directory>'],
+                        args['<budgets>'],
+                        format=args['--format'],
+                        since=args['--since'],
+                        until=args['--until'],
+                )
+            elif args['import_ofx']:
+                import_ofx(
+                        session,
+                        args['<paths>'],
+                        bank=args['--bank'],
                 )
             elif args['reassign_payment']:
                 reassign_payment(
@@ -132,11 +218,25 @@ def main(argv=None, db_path=None):
                         args['<payment-id>'],
                         args['<budget>'],
                 )
+            elif args['reassign_payments']:
+                reassign_payments(
+                        session,
+                        args['<budget>'],
+                        args['<payment-ids>'],
+                        description=args['--description'],
+                        since=args['--since'],
+                        until=args['--until'],
+                )
             elif args['remove_budget']:
                 remove_budget(
                         session,
                         budget=args['<budget>'],
                 )
+            elif args['remove_rule']:
+                remove_rule(
+                        session,
+                        args['<rule-id>'],
+                )
             elif args['rename_budget']:
                 rename_budget(
                         session,
@@ -154,11 +254,18 @@ def main(argv=None, db_path=None):
                         session,
                         args['<budgets>'],
                 )
+            elif args['show_rules']:
+                show_rules(
+                        session,
+                )
             elif args['show_payments']:
                 show_payments(
                         session,
                         args['<budget>'],
                         one_line=args['--one-line'],
+                        since=args['--since'],
+                        until=args['--until'],
+                        limit=args['--limit'],
                 )
             elif args['suggest_allowance']:
                 suggest_allowance(
@@ -186,6 +293,8 @@ def main(argv=None, db_path=None):
                         download=args['--download'] or not args['--no-download'],
                         interactive=not args['--no-interaction'],
                         show_browser=args['--gui'],
+                        workers=parse_workers(args['--jobs']),
+                        sort=args['--sort'],
                 )
     except two_cents.UserError as error:
         print(error)
@@ -227,6 +336,10 @@ def add_budget(session, name, initial_balance, initial_allowance):
     budget = two_cents.Budget(name, initial_balance, initial_allowance)
     session.add(budget)
 
+def add_rule(session, budget, pattern=None, min_amount=None, max_amount=None, account=None):
+    rule = two_cents.Rule(session, budget, pattern, min_amount, max_amount, account)
+    session.add(rule)
+
 def describe_budgets(edit=False):
     import os
     import subprocess
@@ -240,25 +353,88 @@ def describe_budgets(edit=False):
         with open(description_path) as file:
             print(file.read().strip())
 
-def download_payments(session, interactive=True, show_browser=False):
+def download_payments(session, interactive=True, show_browser=False, workers=None):
     two_cents.download_payments(
             session,
             get_username_prompter(interactive),
             get_password_prompter(interactive),
             show_browser=show_browser,
+            workers=workers,
+    )
+    two_cents.apply_rules(session)
+
+def export(session, directory, budgets=(), format='csv', since=None, until=None):
+    from .export import export_db
+
+    num_rows = export_db(
+            session, directory,
+            format=format,
+            budget_names=budgets,
+            since=since and two_cents.parse_date(since),
+            until=until and two_cents.parse_date(until),
     )
+    def count(table):
+        num = num_rows[table]
+        return num, '' if num == 1 else 's'
+
+    print("Exported {} payment{}, {} budget{}, and {} bank{} to '{}'.".format(
+        *count('payments'), *count('budgets'), *count('banks'), directory))
+
+def import_ofx(session, paths, bank=None):
+    if bank is not None:
+        bank = two_cents.get_bank(session, bank)
+    else:
+        banks = two_cents.get_banks(session)
+        if not banks:
+            raise two_cents.UserError("No banks to import payments into.  Use 'two_cents add_bank' to create one.")
+        if len(banks) > 1:
+            raise two_cents.UserError("Use '--bank' to specify which bank the payments came from.")
+        bank = banks[0]
+
+    result = two_cents.import_ofx(session, bank, paths)
+    two_cents.apply_rules(session)
+    print("Imported {} new payment{} ({} already known).".format(
+        result.inserted, '' if result.inserted == 1 else 's', result.duplicates))
 
 def reassign_payment(session, payment_id, budget):
     payment = two_cents.get_payment(session, payment_id)
     payment.assign(budget)
 
+def reassign_payments(session, budget, payment_ids, description=None, since=None, until=None):
+    if not (payment_ids or description or since or until):
+        raise two_cents.UserError("Specify which payments to reassign, either by id or with '--description', '--since', or '--until'.")
+
+    payments = two_cents.query_payments(
+            session,
+            ids=two_cents.check_payment_ids(session, payment_ids) or None,
+            description=description,
+            since=since and two_cents.parse_date(since),
+            until=until and two_cents.parse_date(until),
+    )
+    num_reassigned = two_cents.assign_payments(session, payments, budget)
+    print("Reassigned {} payment{} to '{}'.".format(
+        num_reassigned, '' if num_reassigned == 1 else 's', budget))
+
 def remove_budget(session, budget):
-    budget = two_cents.get_budget(session, budget)
-    session.delete(budget)
+    two_cents.remove_budget(session, budget)
+
+def remove_rule(session, rule_id):
+    rule = two_cents.get_rule(session, rule_id)
+    session.delete(rule)
 
 def rename_budget(session, old_name, new_name):
     two_cents.rename_budget(session, old_name, new_name)
 
+def serve(db_path, socket_path=None):
+    import os
+    from . import server
+
+    if socket_path is None:
+        socket_path = os.environ.get('TWO_CENTS_SOCKET') or \
+                os.path.join(os.path.dirname(db_path), 'server.sock')
+
+    server.serve(socket_path, db_path)
+
 def set_allowance(session, budget, allowance):
     budget = two_cents.get_budget(session, budget)
     budget.allowance = two_cents.parse_allowance(allowance)
@@ -271,53 +447,92 @@ def show_allowance(session, budgets):
                     budget.pretty_allowance,
             ])
 
-def show_payments(session, budget=None, one_line=False):
-    for payment in two_cents.get_payments(session, budget):
-        if one_line:
-            show_payment_tsv(payment)
-        else:
+def show_payments(session, budget=None, one_line=False, since=None, until=None, limit=None):
+    kwargs = dict(
+            since=since and two_cents.parse_date(since),
+            until=until and two_cents.parse_date(until),
+            limit=parse_limit(limit),
+    )
+    if one_line:
+        show_payments_tsv(two_cents.iter_payment_rows(session, budget, **kwargs))
+    else:
+        for payment in two_cents.iter_payments(session, budget, **kwargs):
             show_payment(payment)
             print()
 
+def show_rules(session):
+    rules = two_cents.get_rules(session)
+
+    if not rules:
+        raise two_cents.UserError("No rules to display.  Use 'two_cents add_rule' to create some.")
+
+    with print_table('rll') as table:
+        for rule in rules:
+            criteria = []
+            if rule.pattern is not None:
+                criteria.append("'{}'".format(rule.pattern))
+            if rule.min_amount is not None:
+                criteria.append('>= ' + two_cents.format_dollars(rule.min_amount))
+            if rule.max_amount is not None:
+                criteria.append('<= ' + two_cents.format_dollars(rule.max_amount))
+            if rule.account is not None:
+                criteria.append('****' + rule.account)
+
+            table.add_row([
+                '#{}'.format(rule.id),
+                rule.assignment,
+                ' '.join(criteria),
+            ])
+
 def suggest_allowance(session, budgets, set=False):
+    budgets = two_cents.get_budgets(session, *budgets)
+    suggestions = two_cents.suggest_allowances(session, budgets)
+
     # Populate a table with suggested allowances for each budget, then display 
     # that table.
 
     with print_table('lr') as table:
-        for budget in two_cents.get_budgets(session, *budgets):
+        for budget in budgets:
             table.add_row([
                     budget.name.title(),
-                    "{}/mo".format(two_cents.format_dollars(
-                            two_cents.suggest_allowance(session, budget))),
+                    "{}/mo".format(two_cents.format_dollars(suggestions[budget])),
             ])
 
+    # The suggestions are in dollars per month, but allowances are stored in 
+    # dollars per day.
+
     if set:
-        for budget in two_cents.get_budgets(session, *budgets):
-            budget.allowance = two_cents.suggest_allowance(session, budget)
+        for budget in budgets:
+            budget.allowance = suggestions[budget] / two_cents.days_per_month
 
 def transfer_allowance(session, allowance, budget_from, budget_to):
+    allowance = two_cents.parse_allowance(allowance)
+    budgets = two_cents.get_budgets_by_name(session, [budget_from, budget_to])
     two_cents.transfer_allowance(
-            two_cents.parse_allowance(allowance),
-            two_cents.get_budget(session, budget_from),
-            two_cents.get_budget(session, budget_to))
+            allowance, budgets[budget_from], budgets[budget_to])
 
 def transfer_money(session, dollars, budget_from, budget_to):
+    dollars = two_cents.parse_dollars(dollars)
+    budgets = two_cents.get_budgets_by_name(session, [budget_from, budget_to])
     two_cents.transfer_money(
-            two_cents.parse_dollars(dollars),
-            two_cents.get_budget(session, budget_from),
-            two_cents.get_budget(session, budget_to))
+            dollars, budgets[budget_from], budgets[budget_to])
 
-def update_budgets(session, download=True, interactive=True, show_browser=False):
+def update_budgets(session, download=True, interactive=True, show_browser=False, workers=None, sort=None):
     if two_cents.get_num_budgets(session) == 0:
         raise two_cents.UserError("No budgets to display.  Use 'two_cents add-budget' to create some.")
 
+    # Payments that match any rules are assigned automatically when they're 
+    # downloaded, but rules may also have been added since the last download.
+
     if download:
         print("Downloading recent transactions...")
-        download_payments(session, interactive, show_browser)
+        download_payments(session, interactive, show_browser, workers)
+    else:
+        two_cents.apply_rules(session)
 
     assign_payments(session)
     two_cents.update_allowances(session)
-    show_budgets(session)
+    show_budgets(session, sort)
 
 
 def print(*args, **kwargs):
@@ -356,6 +571,8 @@ def assign_payments(session):
                 print("Please assign the following payments to budgets:")
                 print()
 
+            self.suggester = two_cents.get_assignment_suggester(session)
+
             for payment in payments:
                 self.handle(payment)
 
@@ -363,11 +580,21 @@ def assign_payments(session):
             show_payment(payment, indent='  ')
             print()
 
+            # Suggest whichever assignment was most common for payments with 
+            # similar descriptions.  The user can accept it by pressing Enter.
+
+            suggestions = self.suggester.suggest(payment.description)
+            suggestion = suggestions[0][0] if suggestions else None
+
             while True:
                 
                 # Prompt the user for an assignment.
 
-                command = prompt("Account: ")
+                if suggestion:
+                    command = prompt("Account [{}]: ".format(suggestion))
+                    command = command or suggestion
+                else:
+                    command = prompt("Account: ")
 
                 # See if the user wants to skip assigning one or more payments 
                 # and come back to them later.
@@ -429,7 +656,7 @@ def assign_payments(session):
     loop = ReadEvalPrintLoop()
     loop.go(session)
 
-def show_budgets(session):
+def show_budgets(session, sort=None):
     """
     Print a line briefly summarizing each budget.
     """
@@ -439,7 +666,7 @@ def show_budgets(session):
     # manual padding, then I remove the padding once the table is complete.
 
     with print_table('lr') as table:
-        for budget in two_cents.get_budgets(session):
+        for budget in two_cents.get_budgets(session, order_by=sort or 'id'):
             table.add_row([
                 budget.name.replace('_', ' ').title() + \
                         ' ' * table.right_padding_width,
@@ -488,17 +715,56 @@ def show_payment(payment, indent=''):
         print("{}Description:".format(indent))
         print('\n'.join(description))
 
-def show_payment_tsv(payment):
-    fields = [
-            payment.id,
-            payment.bank.title,
-            payment.account_ending,
-            payment.date,
-            payment.value,
-            payment.assignment,
-            payment.description,
-    ]
-    print('\t'.join(str(x).strip() for x in fields))
+def show_payments_tsv(rows, batch_size=1000):
+    import itertools
+
+    titles = {}
+    rows = iter(rows)
+
+    def format_row(row):
+        if row.scraper_key not in titles:
+            titles[row.scraper_key] = two_cents.find_scraper(row.scraper_key).title
+
+        fields = [
+                row.id,
+                titles[row.scraper_key],
+                '****' + row.account_id[-4:],
+                row.date,
+                row.value,
+                row.assignment,
+                row.description,
+        ]
+        return '\t'.join(str(x).strip() for x in fields)
+
+    # Print the rows in batches, because printing each one individually takes 
+    # a significant amount of time when there are lots of them.
+
+    while True:
+        lines = [format_row(x) for x in itertools.islice(rows, batch_size)]
+        if not lines: break
+        print('\n'.join(lines))
+
+def parse_workers(workers):
+    if workers is None:
+        return None
+    try:
+        num_workers = int(workers)
+    except ValueError:
+        num_workers = 0
+    if num_workers < 1:
+        raise two_cents.UserError("Expected a positive number of jobs, not '{}'.".format(workers))
+    return num_workers
+
+def parse_limit(limit):
+    if limit is None:
+        return None
+    try:
+        num_payments = int(limit)
+    except ValueError:
+        num_payments = -1
+    if num_payments < 0:
+        raise two_cents.UserError("Expected a non-negative number of payments, not '{}'.".format(limit))
+    return num_payments
 
 def get_username_prompter(interactive=True):
     def username_prompter(bank, error_message):
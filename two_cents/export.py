@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+"""
+Export the database in formats that other programs can read.
+
+The payments, budgets and banks are each written to their own file, one 
+chunk of rows at a time, so exporting a large database doesn't require 
+loading all of it into memory.  CSV is always available.  Parquet and Arrow 
+(the IPC file format, which is what pandas calls "feather") require pyarrow.
+"""
+
+import csv
+import itertools
+import os
+
+from .model import (
+        Bank, Budget, Payment, UserError,
+        find_scraper, paginate_payments, query_payments,
+)
+
+formats = {
+        'csv': '.csv',
+        'parquet': '.parquet',
+        'arrow': '.arrow',
+}
+
+# The column names and types of each exported table.  The types are the names 
+# of pyarrow data types, and are only used by the Arrow and Parquet writers.
+
+payment_columns = [
+        ('id', 'int64'),
+        ('bank', 'string'),
+        ('account_id', 'string'),
+        ('date', 'date32'),
+        ('value', 'float64'),
+        ('budget', 'string'),
+        ('ignored', 'bool_'),
+        ('description', 'string'),
+]
+budget_columns = [
+        ('id', 'int64'),
+        ('name', 'string'),
+        ('balance', 'float64'),
+        ('allowance_per_day', 'float64'),
+        ('last_update', 'timestamp'),
+]
+bank_columns = [
+        ('id', 'int64'),
+        ('scraper_key', 'string'),
+        ('title', 'string'),
+        ('last_update', 'timestamp'),
+]
+
+def export_db(session, directory, format='csv', budget_names=(), since=None, until=None, chunk_size=10000):
+    """
+    Write the payments, budgets and banks in the database to files in the 
+    given directory, which is created if necessary.  If any budget names are 
+    given, only those budgets (and the payments assigned to them) are 
+    exported.  The since and until dates restrict which payments are exported. 
+    Return a dictionary mapping each table name to the number of rows written.
+    """
+    if format not in formats:
+        raise ExportError("Can't export to '{}', expected one of: {}.".format(
+            format, ', '.join(sorted(formats))))
+
+    os.makedirs(directory, exist_ok=True)
+
+    def path(name):
+        return os.path.join(directory, name + formats[format])
+
+    tables = [
+            ('payments', payment_columns,
+                iter_payment_records(session, budget_names, since, until, chunk_size)),
+            ('budgets', budget_columns,
+                iter_budget_records(session, budget_names)),
+            ('banks', bank_columns,
+                iter_bank_records(session)),
+    ]
+    num_rows = {}
+
+    for name, columns, records in tables:
+        with open_writer(format, path(name), columns) as writer:
+            num_rows[name] = 0
+            while True:
+                chunk = list(itertools.islice(records, chunk_size))
+                if not chunk: break
+                writer.write(chunk)
+                num_rows[name] += len(chunk)
+
+    return num_rows
+
+def iter_payment_records(session, budget_names=(), since=None, until=None, chunk_size=10000):
+    query = query_payments(session, since=since, until=until)\
+            .join(Payment.bank)\
+            .outerjoin(Payment.budget)\
+            .with_entities(
+                    Payment.id,
+                    Bank.scraper_key,
+                    Payment.account_id,
+                    Payment.date,
+                    Payment.value,
+                    Budget.name,
+                    Payment.ignored,
+                    Payment.description)
+
+    if budget_names:
+        query = query.filter(Budget.name.in_(budget_names))
+
+    for row in paginate_payments(query, page_size=chunk_size):
+        yield tuple(row)
+
+def iter_budget_records(session, budget_names=()):
+    query = session.query(
+            Budget.id,
+            Budget.name,
+            Budget.balance,
+            Budget.allowance,
+            Budget.last_update).order_by(Budget.id)
+
+    if budget_names:
+        query = query.filter(Budget.name.in_(budget_names))
+
+    for row in query:
+        yield tuple(row)
+
+def iter_bank_records(session):
+    query = session.query(
+            Bank.id,
+            Bank.scraper_key,
+            Bank.last_update).order_by(Bank.id)
+
+    for id, scraper_key, last_update in query:
+        yield id, scraper_key, find_scraper(scraper_key).title, last_update
+
+def open_writer(format, path, columns):
+    if format == 'csv':
+        return CsvWriter(path, columns)
+    else:
+        return ArrowWriter(path, columns, format)
+
+
+class CsvWriter:
+
+    def __init__(self, path, columns):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([name for name, type in columns])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+
+    def write(self, records):
+        self.writer.writerows(
+                ['' if x is None else x for x in record]
+                for record in records)
+
+
+class ArrowWriter:
+
+    def __init__(self, path, columns, format):
+        try:
+            import pyarrow
+            import pyarrow.ipc
+            import pyarrow.parquet
+        except ImportError:
+            raise ExportError("Exporting to '{}' requires pyarrow, which isn't installed.".format(format))
+
+        def arrow_type(name):
+            if name == 'timestamp':
+                return pyarrow.timestamp('us')
+            return getattr(pyarrow, name)()
+
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([
+                (name, arrow_type(type)) for name, type in columns])
+
+        if format == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_file(path, self.schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.writer.close()
+
+    def write(self, records):
+        columns = zip(*records)
+        table = self.pyarrow.Table.from_arrays([
+            self.pyarrow.array(values, type=field.type)
+            for values, field in zip(columns, self.schema)
+        ], schema=self.schema)
+        self.writer.write_table(table)
+
+
+class ExportError (UserError):
+    pass
+
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+"""
+Upgrade databases created by older versions of two_cents.
+
+The version of each database's schema is recorded in the schema_version 
+table, so checking whether a database is up to date only takes one query.  
+When it isn't, each of the migrations it's missing is run in order, and the 
+whole upgrade happens in a single transaction: if any migration fails, the 
+database is left exactly as it was.
+
+New migrations should be added to the end of the list with the @migration 
+decorator, and must never be reordered or removed once they've been 
+released.  Databases that predate the schema_version table start at version 
+0, and since they may have been created by any earlier version of two_cents, 
+every migration has to check whether its change has already been made.  Note 
+that rebuild_table() uses the current definition of each table.
+"""
+
+import sqlalchemy
+
+from .model import (
+        Base, Budget, Payment, Watermark, Dollars, PreciseDollars,
+        DollarsPerDay, UserError,
+)
+
+schema_version = sqlalchemy.Table(
+        'schema_version', sqlalchemy.MetaData(),
+        sqlalchemy.Column('version', sqlalchemy.Integer, nullable=False),
+)
+migrations = []
+
+def migration(function):
+    migrations.append(function)
+    return function
+
+def upgrade_db(engine):
+    """
+    Bring the given database up to date, creating it if necessary.
+    """
+    with engine.connect() as connection:
+        if get_schema_version(connection) == len(migrations):
+            return
+
+    with begin_immediate(engine) as connection:
+
+        # Check the version again, now that no one else can be writing to the 
+        # database, in case another process just upgraded it.
+
+        version = get_schema_version(connection)
+
+        if version is None:
+            schema_version.create(connection)
+
+            # If the database is brand new, create the current schema from 
+            # scratch rather than building it up one migration at a time.
+
+            if get_column_type(connection, 'budgets', 'id') is None:
+                Base.metadata.create_all(connection)
+                version = len(migrations)
+            else:
+                version = 0
+
+            connection.execute(schema_version.insert(), {'version': version})
+
+        if version > len(migrations):
+            raise UserError("The database was created by a newer version of two_cents.")
+
+        for i, migrate in enumerate(migrations[version:], version + 1):
+            migrate(connection)
+            connection.execute(schema_version.update().values(version=i))
+
+def get_schema_version(connection):
+    """
+    Return the version of the database's schema, or None if the database 
+    doesn't have a schema_version table.
+    """
+    try:
+        return connection.execute(sqlalchemy.select(schema_version.c.version)).scalar()
+    except sqlalchemy.exc.OperationalError:
+        return None
+
+class begin_immediate:
+    """
+    Open a connection and start a transaction that DDL statements (e.g. 
+    CREATE TABLE) will be part of.
+
+    Python's sqlite3 module normally commits before every DDL statement, which 
+    would make it impossible to roll back a failed migration.  Turning that 
+    behavior off and emitting BEGIN ourselves is the workaround recommended by 
+    the SQLAlchemy documentation.  IMMEDIATE means that the database is locked 
+    for writing right away, so two processes can't upgrade it at once.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def __enter__(self):
+        self.connection = self.engine.connect()
+        self.dbapi_connection = self.connection.connection.driver_connection
+        self.isolation_level = self.dbapi_connection.isolation_level
+        self.dbapi_connection.isolation_level = None
+        self.connection.exec_driver_sql('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.connection.exec_driver_sql('COMMIT')
+            else:
+                self.connection.exec_driver_sql('ROLLBACK')
+        finally:
+            self.dbapi_connection.isolation_level = self.isolation_level
+            self.connection.close()
+
+
+@migration
+def create_missing_tables(connection):
+    """
+    Create any tables that were added after the database was created (e.g. 
+    watermarks, rules, and payment_tokens).
+    """
+    Base.metadata.create_all(connection)
+
+@migration
+def store_budget_money_as_integers(connection):
+    """
+    Money used to be stored as floating point numbers of dollars.  Convert it 
+    to integers in the units used by each column.
+    """
+    if get_column_type(connection, 'budgets', 'balance') == 'FLOAT':
+        rebuild_table(connection, Budget.__table__, {
+                'balance': integer_money_sql('balance', PreciseDollars),
+                'allowance': integer_money_sql('allowance', DollarsPerDay),
+        })
+
+@migration
+def upgrade_payments_table(connection):
+    """
+    Store payment values as integers (see above), and assign payments to 
+    budgets by id rather than by name.
+
+    Payments used to be assigned to budgets by name, with the special name 
+    'ignore' for payments that aren't covered by any budget.  Look up the id 
+    of each named budget.  Names that don't refer to any budget were left 
+    behind by budgets that have since been deleted, and are ignored (the same 
+    thing remove_budget() does now).  Both changes require the table to be 
+    rebuilt, so they're made together.
+    """
+    conversions = {}
+
+    if get_column_type(connection, 'payments', 'value') == 'FLOAT':
+        conversions['value'] = integer_money_sql('value', Dollars)
+
+    if get_column_type(connection, 'payments', 'budget_id') is None:
+        conversions.update({
+            'budget_id': '''(
+                SELECT budgets.id FROM budgets
+                WHERE budgets.name = payments.assignment)''',
+            'ignored': '''
+                assignment IS NOT NULL AND assignment NOT IN (
+                    SELECT budgets.name FROM budgets)''',
+        })
+
+    if conversions:
+        rebuild_table(connection, Payment.__table__, conversions)
+
+@migration
+def create_payment_indexes(connection):
+    """
+    Create the indexes that make the most common payment queries fast, and 
+    drop the index they supersede.
+    """
+    connection.exec_driver_sql('DROP INDEX IF EXISTS ix_payments_budget_id')
+
+    for index in Payment.__table__.indexes:
+        index.create(connection, checkfirst=True)
+
+@migration
+def drop_watermark_transaction_ids(connection):
+    """
+    Watermarks used to record the latest transaction seen for each account.  
+    Now they record the date each account was downloaded through, and the 
+    transaction id isn't needed.  The old dates are never later than the new 
+    ones would be, so they can be kept.
+    """
+    if get_column_type(connection, 'watermarks', 'transaction_id'):
+        rebuild_table(connection, Watermark.__table__)
+
+
+def get_column_type(connection, table, column):
+    """
+    Return the type that the given column was declared with, as reported by 
+    SQLite (e.g. 'INTEGER' or 'FLOAT').
+    """
+    rows = connection.exec_driver_sql('PRAGMA table_info({})'.format(table))
+    for row in rows:
+        if row[1] == column:
+            return row[2].upper()
+
+def rebuild_table(connection, table, conversions=None):
+    """
+    Recreate the given table using its current schema, and copy its existing 
+    rows into the new table.
+
+    SQLite can't change the type of a column (among other things), so this is 
+    how the schema of an existing table has to be changed.  The conversions 
+    argument can map column names to SQL expressions that will be used to fill 
+    in those columns, e.g. to convert values to new units.  Other columns are 
+    copied verbatim.  See https://www.sqlite.org/lang_altertable.html for the 
+    procedure.
+    """
+    conversions = conversions or {}
+    new_name = table.name + '_new'
+
+    # Make the new table in a scratch copy of the schema, so it can refer to 
+    # the other tables via foreign keys without becoming part of the real one.
+
+    scratch = sqlalchemy.MetaData()
+    for other_table in table.metadata.sorted_tables:
+        other_table.to_metadata(scratch)
+    new_table = table.to_metadata(scratch, name=new_name)
+
+    old_columns = [
+            row[1] for row in connection.exec_driver_sql(
+                'PRAGMA table_info({})'.format(table.name))
+    ]
+    columns = [
+            x.name for x in table.columns
+            if x.name in conversions or x.name in old_columns
+    ]
+
+    # The indexes on the old table have to be dropped before the new table is 
+    # created, because the new indexes have the same names.
+
+    for row in connection.exec_driver_sql('PRAGMA index_list({})'.format(table.name)):
+        if not row[1].startswith('sqlite_autoindex'):
+            connection.exec_driver_sql('DROP INDEX {}'.format(row[1]))
+
+    new_table.create(connection)
+    connection.exec_driver_sql('INSERT INTO {} ({}) SELECT {} FROM {}'.format(
+            new_name,
+            ', '.join(columns),
+            ', '.join(conversions.get(x, x) for x in columns),
+            table.name,
+    ))
+    connection.exec_driver_sql('DROP TABLE {}'.format(table.name))
+    connection.exec_driver_sql('ALTER TABLE {} RENAME TO {}'.format(new_name, table.name))
+
+def integer_money_sql(column, type):
+    return 'CAST(round({} * {}) AS INTEGER)'.format(column, type.scale)
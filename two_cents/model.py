@@ -2,25 +2,61 @@
 
 ## Imports
 import datetime
+import functools
+import itertools
 import os
 import shlex
 import sqlalchemy
 import subprocess
 import re
 
+from collections import namedtuple
 from contextlib import contextmanager
 from sqlalchemy.orm import *
 from sqlalchemy.schema import *
 from sqlalchemy.types import *
 from sqlalchemy.ext.declarative import declarative_base
 
-from . import banks
-
 ## Schema Types
 Session = sessionmaker()
 Base = declarative_base()
-Dollars = Float
-DollarsPerDay = Float
+
+class Dollars (TypeDecorator):
+    """
+    Store dollar values as integers, so that they can be added up exactly (and 
+    in SQL) rather than accumulating floating point error.  Python code still 
+    sees floats in units of dollars.  This type stores whole cents, which is 
+    enough for the values of payments.
+    """
+    impl = Integer
+    cache_ok = True
+    scale = 100
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return int(round(value * self.scale))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return value / self.scale
+
+
+class PreciseDollars (Dollars):
+    """
+    Store dollar values as integer millionths of a cent.  Budget balances need 
+    this precision, because allowances accrue a fraction of a cent at a time.
+    """
+    cache_ok = True
+    scale = 100 * 10**6
+
+
+class DollarsPerDay (PreciseDollars):
+    """
+    Store allowances as integer millionths of a cent per day.
+    """
+    cache_ok = True
 
 
 seconds_per_day = 86400
@@ -32,7 +68,7 @@ class Budget (Base):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String, nullable=False, unique=True)
-    balance = Column(Dollars, nullable=False)
+    balance = Column(PreciseDollars, nullable=False)
     allowance = Column(DollarsPerDay, nullable=False)
     last_update = Column(DateTime, nullable=False)
 
@@ -80,10 +116,18 @@ class Budget (Base):
         this_update = now()
         last_update = self.last_update
 
-        dollars_per_second = self.allowance / seconds_per_day
-        seconds_elapsed = (this_update - last_update).total_seconds()
+        # Do the arithmetic with integers, in the same units the database 
+        # uses, so that frequent updates don't accumulate rounding error.
+
+        scale = PreciseDollars.scale
+        balance = int(round(self.balance * scale))
+        allowance = int(round(self.allowance * scale))
+        microseconds_elapsed = (this_update - last_update) // datetime.timedelta(microseconds=1)
+        microseconds_per_day = seconds_per_day * 10**6
 
-        self.balance += dollars_per_second * seconds_elapsed
+        balance += allowance * microseconds_elapsed // microseconds_per_day
+
+        self.balance = balance / scale
         self.last_update = this_update
 
 
@@ -93,9 +137,32 @@ def get_budget(session, name):
     except sqlalchemy.orm.exc.NoResultFound:
         raise NoSuchBudget(name)
 
-def get_budgets(session, *names):
-    budgets = session.query(Budget).all()
-    if names: budgets = [x for x in budgets if x.name in names]
+def get_budgets(session, *names, order_by='id'):
+    """
+    Return the budgets with the given names, or every budget if no names are 
+    given.  The budgets can be sorted by any of the keys in budget_sort_keys.  
+    Names that don't match any budget are ignored.
+    """
+    try:
+        sort_key = budget_sort_keys[order_by]
+    except KeyError:
+        raise UserError("Can't sort budgets by '{}'.  Sort by {}.".format(
+            order_by, ', '.join("'{}'".format(x) for x in budget_sort_keys)))
+
+    query = session.query(Budget)
+    if names: query = query.filter(Budget.name.in_(names))
+    return query.order_by(sort_key, Budget.id).all()
+
+def get_budgets_by_name(session, names):
+    """
+    Return a dictionary mapping each of the given names to the budget with 
+    that name.  All the budgets are looked up with one query.  NoSuchBudget is 
+    raised for the first name (in the given order) that doesn't exist.
+    """
+    budgets = {x.name: x for x in get_budgets(session, *names)}
+    for name in names:
+        if name not in budgets:
+            raise NoSuchBudget(name)
     return budgets
 
 def get_num_budgets(session):
@@ -104,6 +171,13 @@ def get_num_budgets(session):
 def budget_exists(session, name):
     return session.query(Budget).filter_by(name=name).count() > 0
 
+budget_sort_keys = {
+        'id': Budget.id,
+        'name': Budget.name,
+        'balance': Budget.balance,
+        'allowance': Budget.allowance,
+}
+
 
 class Payment (Base):
     __tablename__ = 'payments'
@@ -115,7 +189,27 @@ class Payment (Base):
     date = Column(Date, nullable=False)
     value = Column(Dollars, nullable=False)
     description = Column(Text)
-    assignment = Column(String)
+    budget_id = Column(Integer, ForeignKey('budgets.id'))
+    ignored = Column(Boolean, nullable=False, default=False)
+
+    budget = relationship('Budget')
+
+    # Banks identify each transaction by an account number and a transaction 
+    # id, so use those fields to make sure that the same transaction is never 
+    # recorded twice.  The index also makes it fast to check which of a batch 
+    # of downloaded transactions are already in the database.
+
+    # Payments are most often looked up by budget (to show them, to count the 
+    # unassigned ones, and to suggest allowances), sometimes along with a range 
+    # of dates.  An index on just the date isn't worth having, because SQLite 
+    # prefers to scan the table in order of id (which is how the payments are 
+    # paginated) rather than to use it.
+
+    __table_args__ = (
+            Index('ix_payments_bank_account_transaction',
+                'bank_id', 'account_id', 'transaction_id', unique=True),
+            Index('ix_payments_budget_date', 'budget_id', 'date'),
+    )
 
     def __init__(self, acct_id, txn_id, date, value, description):
         self.account_id = acct_id
@@ -123,6 +217,7 @@ class Payment (Base):
         self.date = date
         self.value = parse_dollars(value)
         self.description = description
+        self.ignored = False
 
     def __repr__(self):  # pragma: no cover
         date = format_date(self.date)
@@ -151,38 +246,45 @@ class Payment (Base):
 
         # Make sure the new assignment actually exists.
 
-        try:
-            if assignment != 'ignore':
-                new_budget = get_budget(session, assignment)
-        except NoSuchBudget:
-            raise NoSuchBudget(assignment)
-
-        # If this payment was already assigned to another budget, make sure 
-        # that budget still exists.  If it doesn't, raise an exception because 
-        # there's no way to credit the value of this payment.  If it does, then 
-        # credit it the value of this payment.
+        if assignment != 'ignore':
+            new_budget = get_budget(session, assignment)
 
-        if self.assignment not in (None, 'ignore'):
-            try:
-                old_budget = get_budget(session, self.assignment)
-            except NoSuchBudget:
-                raise AssignmentError("Payment #{} assigned to '{}', which no longer exists.".format(self.id, self.assignment))
+        # If this payment was already assigned to another budget, credit that 
+        # budget the value of this payment.  Budgets can't be deleted out from 
+        # under their payments anymore (see remove_budget()), so there's no 
+        # need to check that the old budget still exists.
 
-            old_budget.balance -= self.value
+        if self.budget is not None:
+            self.budget.balance -= self.value
 
         # Debit the new assignment the value of this payment.
 
-        if assignment != 'ignore':
+        if assignment == 'ignore':
+            self.budget = None
+            self.ignored = True
+        else:
             new_budget.balance += self.value
-
-        self.assignment = assignment
+            self.budget = new_budget
+            self.ignored = False
 
     def ignore(self):
         if self.assignment is None:
-            self.assignment = 'ignore'
+            self.ignored = True
         else:
             raise AssignmentError("Payment can't be ignored because it's already assigned to '{}'.".format(self.assignment))
 
+    @property
+    def assignment(self):
+        """
+        The name of the budget this payment is assigned to, 'ignore' if the 
+        payment is being ignored, or None if it hasn't been assigned yet.
+        """
+        if self.ignored:
+            return 'ignore'
+        if self.budget is not None:
+            return self.budget.name
+        return None
+
     @property
     def account_ending(self):
         return '****' + self.account_id[-4:]
@@ -194,16 +296,680 @@ def get_payment(session, id):
     else: return payment
 
 def get_payments(session, budget_name=None):
-    if budget_name is not None:
-        return session.query(Payment).filter_by(assignment=budget_name).all()
+    return query_payments(session, budget_name).all()
+
+def iter_payments(session, budget_name=None, since=None, until=None, limit=None, page_size=1000):
+    """
+    Yield the payments matching the given criteria (see query_payments()) in 
+    the order they were recorded, without loading them all at once.
+    """
+    query = query_payments(session, budget_name, since=since, until=until)
+    return paginate_payments(query, limit, page_size)
+
+def iter_payment_rows(session, budget_name=None, since=None, until=None, limit=None, page_size=10000):
+    """
+    Like iter_payments(), but yield plain rows instead of Payment objects.  
+    Each row has the following fields: id, scraper_key, account_id, date, 
+    value, assignment, description.
+
+    The rows are selected by a single query (per page) that joins the banks 
+    and budgets tables, so this is much faster than iter_payments() when all 
+    that's needed is to print out a lot of payments.
+    """
+    assignment = sqlalchemy.case(
+            (Payment.ignored == True, 'ignore'),
+            else_=Budget.name)
+
+    query = query_payments(session, budget_name, since=since, until=until)\
+            .join(Payment.bank)\
+            .outerjoin(Payment.budget)\
+            .with_entities(
+                    Payment.id,
+                    Bank.scraper_key,
+                    Payment.account_id,
+                    Payment.date,
+                    Payment.value,
+                    assignment.label('assignment'),
+                    Payment.description)
+
+    return paginate_payments(query, limit, page_size)
+
+def paginate_payments(query, limit=None, page_size=1000):
+    """
+    Yield the results of the given payment query in order of payment id, one 
+    page at a time.
+
+    Each page starts after the id of the last payment on the previous page 
+    (rather than at an OFFSET, which would have to skip over every preceding 
+    row).  Pages that have been completely yielded are no longer referenced, 
+    so memory use doesn't depend on how many payments there are.
+    """
+    last_id = None
+    num_yielded = 0
+
+    while limit is None or num_yielded < limit:
+        page = query.order_by(Payment.id)
+        if last_id is not None:
+            page = page.filter(Payment.id > last_id)
+
+        size = page_size if limit is None else min(page_size, limit - num_yielded)
+        results = page.limit(size).all()
+
+        yield from results
+        num_yielded += len(results)
+
+        if len(results) < size:
+            break
+
+        last_id = results[-1].id
+        del results
+
+def query_payments(session, budget_name=None, ids=None, description=None, since=None, until=None):
+    """
+    Return a query for the payments that match all of the given criteria.  
+    The description is matched case-insensitively against any part of each 
+    payment's description, and may contain '%' wildcards.  The since and until 
+    dates are both inclusive.
+
+    The criteria are all expressed without joins, so the query can also be 
+    used to update the payments it selects in bulk.
+    """
+    query = session.query(Payment)
+
+    if budget_name == 'ignore':
+        query = query.filter(Payment.ignored == True)
+    elif budget_name is not None:
+        budget_id = sqlalchemy.select(Budget.id)\
+                .where(Budget.name == budget_name)\
+                .correlate(None)\
+                .scalar_subquery()
+        query = query.filter(Payment.budget_id == budget_id)
+
+    if ids is not None:
+        query = query.filter(Payment.id.in_(ids))
+    if description is not None:
+        query = query.filter(Payment.description.ilike('%{}%'.format(description)))
+    if since is not None:
+        query = query.filter(Payment.date >= as_date(since))
+    if until is not None:
+        query = query.filter(Payment.date <= as_date(until))
+
+    return query
+
+def check_payment_ids(session, ids):
+    """
+    Raise NoSuchPayment if any of the given ids doesn't belong to a payment.
+    """
+    def parse_id(id):
+        try: return int(id)
+        except ValueError: raise NoSuchPayment(id)
+
+    ids = [parse_id(x) for x in ids]
+    found = {x for x, in session.query(Payment.id).filter(Payment.id.in_(ids))}
+    for id in ids:
+        if id not in found:
+            raise NoSuchPayment(id)
+
+    return ids
+
+def assign_payments(session, payments, assignment):
+    """
+    Assign every payment selected by the given query (see query_payments()) to 
+    the given budget, or ignore them if the assignment is 'ignore'.  Return the 
+    number of payments that were reassigned.
+
+    This does the same thing as calling Payment.assign() for each payment, but 
+    the payments are never loaded.  Instead, the net change in the balance of 
+    each affected budget is calculated by one aggregate query and all the 
+    payments are reassigned by one UPDATE statement.  Payments that are already 
+    assigned to the given budget are left alone.
+    """
+    if assignment == 'ignore':
+        new_budget = None
+        changed = Payment.ignored == False
     else:
-        return session.query(Payment).all()
+        new_budget = get_budget(session, assignment)
+        changed = Payment.budget_id.is_distinct_from(new_budget.id)
+
+    session.flush()
+    payments = payments.filter(changed)
+
+    totals = payments\
+            .with_entities(
+                Payment.budget_id,
+                sqlalchemy.func.sum(Payment.value),
+                sqlalchemy.func.count())\
+            .group_by(Payment.budget_id)\
+            .all()
+
+    old_budget_ids = [id for id, total, count in totals if id is not None]
+    old_budgets = {
+            x.id: x for x in
+            session.query(Budget).filter(Budget.id.in_(old_budget_ids))
+    }
+
+    for id, total, count in totals:
+        if id is not None:
+            old_budgets[id].balance -= total
+        if new_budget is not None:
+            new_budget.balance += total
+
+    num_assigned = payments.update({
+            Payment.budget_id: new_budget and new_budget.id,
+            Payment.ignored: new_budget is None,
+    }, synchronize_session=False)
+
+    expire_assignments(session)
+    return num_assigned
+
+def expire_assignments(session):
+    """
+    Make sure that any payments that have already been loaded will reload their 
+    assignments, after they've been changed behind the ORM's back.
+    """
+    for object in session.identity_map.values():
+        if isinstance(object, Payment):
+            session.expire(object, ['budget_id', 'budget', 'ignored'])
+
+def get_payment_keys(session, bank, keys, chunk_size=500):
+    """
+    Return the subset of the given (account id, transaction id) tuples that 
+    are already recorded for the given bank.
+    """
+    transaction_ids = {}
+    for account_id, transaction_id in keys:
+        transaction_ids.setdefault(account_id, set()).add(transaction_id)
+
+    # Query each account separately, so that SQLite can look up every id 
+    # using all three columns of the unique index, rather than scanning every 
+    # payment from the bank.  Query the ids in chunks to stay below SQLite's 
+    # limit on the number of parameters that can be bound to a single 
+    # statement.
+
+    known_keys = set()
+
+    for account_id, ids in transaction_ids.items():
+        ids = sorted(ids)
+        for i in range(0, len(ids), chunk_size):
+            query = session.query(Payment.account_id, Payment.transaction_id)\
+                    .filter(Payment.bank_id == bank.id)\
+                    .filter(Payment.account_id == account_id)\
+                    .filter(Payment.transaction_id.in_(ids[i:i+chunk_size]))
+            known_keys.update(tuple(x) for x in query)
+
+    return known_keys
+
+def ingest_transactions(session, bank, transactions, batch_size=1000):
+    """
+    Record the given transactions as payments from the given bank.
+
+    The transactions should be an iterable of (account number, transaction) 
+    tuples, where each transaction has the same attributes as the transactions 
+    parsed by two_cents.ofx.  The transactions are processed in batches, and each 
+    batch is written to the database with a single executemany() statement 
+    rather than by creating and flushing an ORM object for each payment.  
+    Transactions that are already in the database are skipped.  Return an 
+    IngestResult with the number of payments that were inserted and the number 
+    of duplicates that were skipped.
+    """
+    # Make sure the bank has an id and that any pending payments are visible 
+    # to the duplicate check.
+    session.flush()
+
+    num_inserted = num_duplicates = 0
+    transactions = iter(transactions)
+
+    while True:
+        batch = list(itertools.islice(transactions, batch_size))
+        if not batch:
+            break
+
+        rows = []
+        known_keys = get_payment_keys(
+                session, bank, [(n, x.id) for n, x in batch])
+
+        for account_number, transaction in batch:
+            key = account_number, transaction.id
+            if key in known_keys:
+                num_duplicates += 1
+                continue
+
+            rows.append(dict(
+                    bank_id=bank.id,
+                    account_id=account_number,
+                    transaction_id=transaction.id,
+                    date=as_date(transaction.date),
+                    value=parse_dollars(transaction.amount),
+                    description=transaction.payee + ' ' + transaction.memo,
+            ))
+            known_keys.add(key)
+
+        if rows:
+            session.execute(Payment.__table__.insert(), rows)
+            num_inserted += len(rows)
+
+    # The payments were inserted behind the ORM's back, so make sure the 
+    # bank's list of payments gets reloaded if anyone asks for it.
+    session.expire(bank, ['payments'])
+
+    return IngestResult(num_inserted, num_duplicates)
+
+def iter_transactions(accounts):
+    """
+    Yield an (account number, transaction) tuple for every transaction in the 
+    given accounts, which should be parsed by two_cents.ofx (or have the same 
+    attributes).
+    """
+    for account in accounts:
+        for transaction in account.statement.transactions:
+            yield account.number, transaction
 
 def get_unassigned_payments(session):
-    return session.query(Payment).filter_by(assignment=None).all()
+    return query_unassigned_payments(session).all()
 
 def get_num_unassigned_payments(session):
-    return session.query(Payment).filter_by(assignment=None).count()
+    return query_unassigned_payments(session).count()
+
+def query_unassigned_payments(session):
+    return session.query(Payment).filter(
+            Payment.budget_id == None,
+            Payment.ignored == False)
+
+
+IngestResult = namedtuple('IngestResult', 'inserted duplicates')
+
+
+class Watermark (Base):
+    """
+    Record the date that each account was last successfully downloaded 
+    through, so that the next download only has to ask for newer transactions.
+    """
+    __tablename__ = 'watermarks'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    bank_id = Column(Integer, ForeignKey('banks.id'), nullable=False)
+    account_id = Column(String, nullable=False)
+    date = Column(Date, nullable=False)
+
+    __table_args__ = (
+            UniqueConstraint('bank_id', 'account_id'),
+    )
+
+    def __repr__(self):  # pragma: no cover
+        return '<Watermark account={0.account_id} date={0.date}>'.format(self)
+
+
+def get_watermarks(session, bank):
+    """
+    Return a dictionary mapping the account numbers for the given bank to the 
+    date that account was last downloaded through.
+    """
+    watermarks = session.query(Watermark).filter_by(bank_id=bank.id)
+    return {x.account_id: x.date for x in watermarks}
+
+def update_watermarks(session, bank, accounts, date):
+    """
+    Record that the given accounts were downloaded through the given date.  
+    Watermarks never move backwards.
+    """
+    watermarks = {
+            x.account_id: x for x in
+            session.query(Watermark).filter_by(bank_id=bank.id)
+    }
+
+    for account in accounts:
+        watermark = watermarks.get(account)
+
+        if watermark is None:
+            session.add(Watermark(
+                    bank_id=bank.id,
+                    account_id=account,
+                    date=date,
+            ))
+        elif date > watermark.date:
+            watermark.date = date
+
+# Banks sometimes post transactions a few days after the date they're recorded 
+# with (e.g. pending transactions), so each download starts this long before 
+# the date the account was last downloaded through.
+watermark_overlap = datetime.timedelta(days=14)
+
+# How far before the bank's last update to download from if nothing better is 
+# known.  This was the window for every download before watermarks existed, 
+# and no download ever starts earlier than this (e.g. because of an account 
+# that hasn't shown up in a download for a long time).
+download_window = datetime.timedelta(days=30)
+
+
+class Rule (Base):
+    """
+    Automatically assign payments that match certain criteria to a budget (or 
+    ignore them).  A payment matches a rule if its description contains the 
+    rule's pattern (ignoring case), if its amount (ignoring sign) is between 
+    the rule's minimum and maximum, and if its account number ends with the 
+    rule's account digits.  Criteria that aren't specified always match.
+    """
+    __tablename__ = 'rules'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    budget_id = Column(Integer, ForeignKey('budgets.id'))
+    ignored = Column(Boolean, nullable=False, default=False)
+    pattern = Column(String)
+    min_amount = Column(Dollars)
+    max_amount = Column(Dollars)
+    account = Column(String)
+
+    budget = relationship('Budget')
+
+    def __init__(self, session, assignment, pattern=None, min_amount=None, max_amount=None, account=None):
+        if not (pattern or min_amount is not None or max_amount is not None or account):
+            raise UserError("A rule needs at least one criterion, or else it would match every payment.")
+
+        if assignment == 'ignore':
+            self.budget = None
+            self.ignored = True
+        else:
+            self.budget = get_budget(session, assignment)
+            self.ignored = False
+
+        self.pattern = pattern or None
+        self.min_amount = None if min_amount is None else parse_dollars(min_amount)
+        self.max_amount = None if max_amount is None else parse_dollars(max_amount)
+        self.account = account or None
+
+    def __repr__(self):  # pragma: no cover
+        return '<Rule id={0.id} assignment={0.assignment} pattern={0.pattern!r}>'.format(self)
+
+    @property
+    def assignment(self):
+        return 'ignore' if self.ignored else self.budget.name
+
+    def matches(self, account_id, value):
+        """
+        Return true if a payment with the given account number and value meets 
+        this rule's criteria (other than the description, which is handled by 
+        RuleMatcher).
+        """
+        amount = abs(value)
+        if self.min_amount is not None and amount < self.min_amount:
+            return False
+        if self.max_amount is not None and amount > self.max_amount:
+            return False
+        if self.account is not None and not account_id.endswith(self.account):
+            return False
+        return True
+
+
+def get_rule(session, id):
+    rule = session.query(Rule).get(id)
+    if rule is None: raise NoSuchRule(id)
+    else: return rule
+
+def get_rules(session):
+    return session.query(Rule).order_by(Rule.id).all()
+
+def apply_rules(session, chunk_size=500):
+    """
+    Assign every unassigned payment that matches a rule.  If a payment matches 
+    more than one rule, the one that was added first wins.  Return the number 
+    of payments that were assigned.
+
+    The rules are compiled into a single RuleMatcher, so each payment's 
+    description only has to be scanned once no matter how many rules there 
+    are.  The payments are read as plain rows and assigned in bulk, one 
+    budget at a time.
+    """
+    rules = get_rules(session)
+    if not rules:
+        return 0
+
+    matcher = RuleMatcher(rules)
+    matches = {}
+
+    query = query_unassigned_payments(session).with_entities(
+            Payment.id, Payment.account_id, Payment.value, Payment.description)
+
+    for id, account_id, value, description in query:
+        rule = matcher.match(description or '', account_id or '', value)
+        if rule is not None:
+            matches.setdefault(rule.assignment, []).append(id)
+
+    num_assigned = 0
+
+    for assignment, ids in matches.items():
+        for i in range(0, len(ids), chunk_size):
+            payments = query_payments(session, ids=ids[i:i+chunk_size])
+            num_assigned += assign_payments(session, payments, assignment)
+
+    return num_assigned
+
+
+class RuleMatcher:
+    """
+    Find the first rule that matches a payment.
+
+    The patterns of all the rules are compiled into an Aho-Corasick automaton, 
+    which finds every pattern that occurs in a description in a single pass 
+    over it.  That takes the same amount of time however many rules there 
+    are, which matters because people tend to accumulate a lot of rules.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.always = []
+
+        # Each state of the automaton is a dictionary mapping characters to the 
+        # next state.  State 0 is the root.  The outputs of each state are the 
+        # indices of the rules whose patterns end at that state.
+
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+
+        for index, rule in enumerate(self.rules):
+            if not rule.pattern:
+                self.always.append(index)
+                continue
+
+            state = 0
+            for char in rule.pattern.lower():
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.outputs.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+
+            self.outputs[state].append(index)
+
+        # Find the failure link for each state (i.e. the state for the longest 
+        # proper suffix of its string that is also in the automaton) with a 
+        # breadth-first search, and merge the outputs along the way.
+
+        queue = list(self.goto[0].values())
+
+        for state in queue:
+            for char, next in self.goto[state].items():
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+
+                self.fail[next] = self.goto[fail].get(char, 0)
+                self.outputs[next] = self.outputs[next] + self.outputs[self.fail[next]]
+                queue.append(next)
+
+    def find(self, description):
+        """
+        Return the set of indices of the rules whose patterns occur in the 
+        given description.
+        """
+        found = set(self.always)
+        state = 0
+
+        for char in description.lower():
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            found.update(self.outputs[state])
+
+        return found
+
+    def match(self, description, account_id, value):
+        """
+        Return the first rule that matches the given payment, or None if no 
+        rules match.
+        """
+        for index in sorted(self.find(description)):
+            rule = self.rules[index]
+            if rule.matches(account_id, value):
+                return rule
+
+
+class PaymentToken (Base):
+    """
+    Record which words appear in the description of each payment.  This is 
+    used to suggest assignments for new payments based on how payments with 
+    similar descriptions were assigned in the past.  Splitting descriptions 
+    into words is the slow part of making those suggestions, so it's only 
+    done once for each payment (see update_payment_tokens()).
+    """
+    __tablename__ = 'payment_tokens'
+
+    payment_id = Column(Integer, ForeignKey('payments.id'), primary_key=True)
+    token = Column(String, primary_key=True)
+
+
+def update_payment_tokens(session, batch_size=1000):
+    """
+    Record the tokens in the descriptions of any payments that haven't been 
+    tokenized yet.  Payments are tokenized in order of id, so only payments 
+    newer than the last one with any tokens need to be looked at.
+    """
+    session.flush()
+    last_id = session.query(sqlalchemy.func.max(PaymentToken.payment_id)).scalar()
+
+    query = session.query(Payment.id, Payment.description)
+    if last_id is not None:
+        query = query.filter(Payment.id > last_id)
+
+    rows = (
+            dict(payment_id=id, token=token)
+            for id, description in query
+            for token in tokenize_description(description)
+    )
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch: break
+        session.execute(PaymentToken.__table__.insert(), batch)
+
+def tokenize_description(description):
+    """
+    Return the set of words in the given payment description, ignoring case.  
+    Numbers are left out, because they're usually things like store numbers 
+    and transaction ids that don't say anything about what the payment was 
+    for.
+    """
+    tokens = re.findall('[a-z0-9]+', (description or '').lower())
+    return {x for x in tokens if not x.isdigit()}
+
+def get_assignment_suggester(session):
+    """
+    Return an AssignmentSuggester that has learned from every payment that's 
+    been assigned so far.
+    """
+    update_payment_tokens(session)
+
+    assignment = sqlalchemy.case(
+            (Payment.ignored == True, 'ignore'),
+            else_=Budget.name)
+    assigned = sqlalchemy.or_(
+            Payment.budget_id != None,
+            Payment.ignored == True)
+
+    # Count how many payments with each assignment contain each token, and how 
+    # many payments have each assignment.  These two aggregate queries are 
+    # all the suggester needs, so the payments themselves are never loaded.
+
+    token_counts = session.query(
+                PaymentToken.token,
+                assignment,
+                sqlalchemy.func.count())\
+            .select_from(PaymentToken)\
+            .join(Payment, Payment.id == PaymentToken.payment_id)\
+            .outerjoin(Payment.budget)\
+            .filter(assigned)\
+            .group_by(PaymentToken.token, assignment)
+
+    payment_counts = session.query(
+                assignment,
+                sqlalchemy.func.count())\
+            .select_from(Payment)\
+            .outerjoin(Payment.budget)\
+            .filter(assigned)\
+            .group_by(assignment)
+
+    return AssignmentSuggester(token_counts, payment_counts)
+
+
+class AssignmentSuggester:
+    """
+    Suggest assignments for payments using a TF-IDF model of the descriptions 
+    of the payments that have already been assigned.
+
+    Each assignment (i.e. each budget, plus 'ignore') is treated as a document 
+    made up of the descriptions of all its payments.  Each token in that 
+    document is weighted by the fraction of the assignment's payments that 
+    contain it (the term frequency) and by how rare the token is among all 
+    payments (the inverse document frequency).  An inverted index maps each 
+    token to its weight in each assignment, so scoring a payment only takes 
+    one dictionary lookup per word in its description.
+    """
+
+    def __init__(self, token_counts, payment_counts):
+        import math
+
+        token_counts = list(token_counts)
+        payment_counts = dict(payment_counts)
+        num_payments = sum(payment_counts.values())
+
+        document_frequencies = {}
+        for token, assignment, count in token_counts:
+            document_frequencies[token] = \
+                    document_frequencies.get(token, 0) + count
+
+        self.idf = {
+                token: math.log(1 + num_payments / count)
+                for token, count in document_frequencies.items()
+        }
+        self.index = {}
+        norms = {}
+
+        for token, assignment, count in token_counts:
+            weight = count / payment_counts[assignment] * self.idf[token]
+            self.index.setdefault(token, []).append([assignment, weight])
+            norms[assignment] = norms.get(assignment, 0) + weight**2
+
+        # Normalize the weights so that assignments with lots of different 
+        # tokens aren't favored just because of that.
+
+        for postings in self.index.values():
+            for posting in postings:
+                posting[1] /= math.sqrt(norms[posting[0]])
+
+    def suggest(self, description):
+        """
+        Return a list of (assignment, score) tuples for the given payment 
+        description, best first.  The list is empty if none of the words in 
+        the description have been seen before.
+        """
+        scores = {}
+
+        for token in tokenize_description(description):
+            idf = self.idf.get(token, 0)
+            for assignment, weight in self.index.get(token, ()):
+                scores[assignment] = scores.get(assignment, 0) + weight * idf
+
+        return sorted(scores.items(), key=lambda x: (-x[1], x[0]))
 
 
 class Bank (Base):
@@ -219,8 +985,7 @@ class Bank (Base):
     def __init__(self, session, scraper_key):
         if bank_exists(session, scraper_key):
             raise UserError("Bank '{}' already exists.".format(scraper_key))
-        if scraper_key not in scraper_classes:
-            raise NoSuchScraper(scraper_key)
+        find_scraper(scraper_key)  # Make sure the scraper exists.
 
         self.scraper_key = scraper_key
         self.username_command = None
@@ -231,6 +996,20 @@ class Bank (Base):
         """
         Download new transactions from this bank.
         """
+        download = self.prepare_download(
+                username_callback, password_callback, show_browser)
+        return self.record_payments(download())
+
+    def prepare_download(self, username_callback, password_callback, show_browser=False):
+        """
+        Return a function that will download new transactions from this bank 
+        and return them as a list of accounts.
+
+        Any prompting for usernames and passwords happens before this method 
+        returns, and the returned function doesn't touch the database, so it 
+        can safely be called from a different thread.  Pass the accounts it 
+        returns to record_payments().
+        """
 
         # Get a username and password the scraper can use to download data from 
         # this bank.  Commands to generate user names and passwords can be 
@@ -254,31 +1033,59 @@ class Bank (Base):
         username = get_user_info(self.username_command, username_callback)
         password = get_user_info(self.password_command, password_callback)
 
-        # Scrape new transactions from the bank website, and store those 
-        # transactions in the database as payments.
+        scraper_class = find_scraper(self.scraper_key).load()
+        scraper = scraper_class(username, password, show_browser)
+
+        # Only ask for transactions that might not be in the database yet.  
+        # Scrapers that can download each account separately (e.g. via OFX 
+        # Direct Connect) use a separate window for each account.  Others have 
+        # to use the earliest window.  If nothing has been downloaded from 
+        # this bank yet, just get the last month.
 
         session = Session.object_session(self)
-        scraper_class = scraper_classes[self.scraper_key]
-        scraper = scraper_class(username, password, show_browser)
-        start_date = self.last_update - datetime.timedelta(days=30)
+        earliest = as_date(self.last_update - download_window)
+        account_dates = {
+                account: max(date - watermark_overlap, earliest)
+                for account, date in get_watermarks(session, self).items()
+        }
+        if account_dates:
+            start_date = min(account_dates.values())
+        else:
+            start_date = self.last_update - download_window
 
-        for account in scraper.download(start_date):
-            for transaction in account.statement.transactions:
-                payment = Payment(
-                        account.number,
-                        transaction.id,
-                        transaction.date,
-                        transaction.amount,
-                        transaction.payee + ' ' + transaction.memo)
+        # Scrapers written before per-account windows existed (including 
+        # plugins) don't take the account_dates argument, so only pass it to 
+        # scrapers that ask for it.
 
-                if payment not in self.payments:
-                    self.payments.append(payment)
+        if accepts_argument(scraper.download, 'account_dates'):
+            return functools.partial(
+                    scraper.download, start_date, account_dates=account_dates)
+        else:
+            return functools.partial(scraper.download, start_date)
+
+    def record_payments(self, accounts):
+        """
+        Store the transactions in the given accounts (as returned by a 
+        scraper) in the database as payments.
+        """
+        session = Session.object_session(self)
+        accounts = list(accounts)
+        result = ingest_transactions(session, self, iter_transactions(accounts))
+
+        # Every account the scraper returned was downloaded through today, 
+        # even if it had no new transactions.
 
         self.last_update = now()
+        update_watermarks(
+                session, self,
+                [x.number for x in accounts],
+                as_date(self.last_update))
+
+        return result
 
     @property
     def title(self):
-        return scraper_titles[self.scraper_key]
+        return find_scraper(self.scraper_key).title
 
 
 def get_bank(session, key):
@@ -297,17 +1104,112 @@ def bank_exists(session, key):
     return session.query(Bank).filter_by(scraper_key=key).count() > 0
 
 
-scraper_classes = {
-        'wells_fargo': banks.WellsFargo,
-}
+class Scraper:
+    """
+    Describe a class that can download transactions from a particular bank.
+
+    The scraper classes themselves are only imported when they're needed to 
+    download something, because they depend on some heavy libraries (e.g.  
+    selenium) that most commands don't otherwise need.
+    """
+
+    def __init__(self, key, title, path):
+        self.key = key
+        self.title = title
+        self.path = path
+
+    def __repr__(self):  # pragma: no cover
+        return '<Scraper key={0.key} path={0.path}>'.format(self)
+
+    def load(self):
+        import importlib
+        module_name, class_name = self.path.split(':')
+        module = importlib.import_module(module_name)
+        return getattr(module, class_name)
+
+
+scrapers = {}
+scraper_entry_point_group = 'two_cents.scrapers'
+
+def accepts_argument(function, name):
+    """
+    Return true if the given function can be called with the given keyword 
+    argument.
+    """
+    import inspect
+    parameters = inspect.signature(function).parameters
+    return name in parameters or any(
+            x.kind == inspect.Parameter.VAR_KEYWORD
+            for x in parameters.values())
+
+def register_scraper(key, title, path):
+    """
+    Make a scraper available to the rest of the program.  The path should have 
+    the form 'module.name:ClassName', and the module won't be imported until 
+    a bank that uses this scraper downloads something.
+    """
+    scrapers[key] = Scraper(key, title, path)
 
-scraper_titles = {
-        'wells_fargo': 'Wells Fargo',
+def find_scraper(key):
+    if key not in scrapers:
+        find_plugin_scrapers()
+    try:
+        return scrapers[key]
+    except KeyError:
+        raise NoSuchScraper(key)
+
+def find_plugin_scrapers():
+    """
+    Register any scrapers that other packages advertise via the 
+    'two_cents.scrapers' entry point group.  The name of each entry point is 
+    used as the scraper key, and its value should refer to the scraper class.  
+    Entry points are only searched when a scraper that wasn't built into this 
+    package is requested, because searching them is relatively slow.
+    """
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:  # pragma: no cover
+        return
+
+    entry_points = entry_points()
+    if hasattr(entry_points, 'select'):
+        entry_points = entry_points.select(group=scraper_entry_point_group)
+    else:  # pragma: no cover
+        entry_points = entry_points.get(scraper_entry_point_group, [])
+
+    for entry_point in entry_points:
+        if entry_point.name not in scrapers:
+            title = entry_point.name.replace('_', ' ').title()
+            register_scraper(entry_point.name, title, entry_point.value)
+
+register_scraper('wells_fargo', 'Wells Fargo', 'two_cents.banks:WellsFargo')
+register_scraper('wells_fargo_ofx', 'Wells Fargo', 'two_cents.ofx:WellsFargoDirectConnect')
+
+
+# The pragmas that are applied to every connection to the database.  WAL mode 
+# lets readers (e.g. show_budgets) keep working while a download is writing to 
+# the database, and with WAL the database can't be corrupted by a crash even 
+# if synchronous is NORMAL (although the last few transactions might be lost), 
+# which saves an fsync on every commit.  The cache size is in KiB if it's 
+# negative, the mmap size is in bytes, and the busy timeout is in ms.  Any 
+# pragma can be left at SQLite's default by setting it to None.  See 
+# https://www.sqlite.org/pragma.html for more information.
+
+sqlite_pragmas = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -16 * 1024,
+        'mmap_size': 256 * 1024**2,
+        'busy_timeout': 5000,
 }
 
+# The engines that have been kept open by open_db(persistent=True), keyed by 
+# the path to the database and the pragmas applied to its connections.  Each 
+# engine is stored with the identity of the file it was opened on.
+engines = {}
 
 @contextmanager
-def open_db(path):
+def open_db(path, pragmas=None, persistent=False):
     # Make sure the database directory exists.
 
     path = os.path.abspath(os.path.expanduser(path))
@@ -316,10 +1218,15 @@ def open_db(path):
 
     # Create an database session.  Currently the whole program is hard-coded to 
     # use SQLite, but in the future I may want to use MySQL to make budgets 
-    # accessible from many devices.
+    # accessible from many devices.  Long-running processes (i.e. the server) 
+    # can ask for the engine to be kept around between sessions, so that the 
+    # connections don't have to be reopened every time.
+
+    if persistent:
+        engine = get_persistent_engine(path, pragmas)
+    else:
+        engine = create_db_engine(path, pragmas)
 
-    engine = sqlalchemy.create_engine('sqlite:///' + path)
-    Base.metadata.create_all(engine)
     session = sqlalchemy.orm.sessionmaker(bind=engine)()
 
     # Return the session to the calling code.  If the calling code completes 
@@ -334,26 +1241,230 @@ def open_db(path):
         raise
     finally:
         session.close()
+        if not persistent:
+            engine.dispose()
+
+def create_db_engine(path, pragmas=None):
+    """
+    Create an engine for the SQLite database at the given path, and make sure 
+    the database is up to date.
+    """
+    pragmas = dict(sqlite_pragmas, **(pragmas or {}))
+    engine = sqlalchemy.create_engine('sqlite:///' + path)
+    sqlalchemy.event.listen(engine, 'connect',
+            lambda connection, record: apply_pragmas(connection, pragmas))
+
+    from .migrations import upgrade_db
+    upgrade_db(engine)
+    return engine
+
+def get_persistent_engine(path, pragmas=None):
+    """
+    Return the engine that open_db(persistent=True) cached for the given path 
+    and pragmas, creating it if necessary.
+    """
+    from .migrations import upgrade_db
+
+    key = path, frozenset((pragmas or {}).items())
+    engine, file_id = engines.get(key, (None, None))
+
+    # If the database was deleted or replaced (e.g. restored from a backup), 
+    # the pooled connections still refer to the old file, so start over.
 
-def download_payments(session, username_callback, password_callback, show_browser=False):
-    for bank in get_banks(session):
-        bank.download_payments(username_callback, password_callback, show_browser)
+    if engine is not None and file_id != get_file_id(path):
+        engine.dispose()
+        engine = None
 
-def update_allowances(session):
-    for budget in get_budgets(session):
-        budget.update_allowance()
+    # Otherwise check the schema version again, because another process (e.g. 
+    # a cron download using a newer two_cents) may have migrated the database.  
+    # If nothing changed, this is just one SELECT.
+
+    if engine is None:
+        engine = create_db_engine(path, pragmas)
+        engines[key] = engine, get_file_id(path)
+    else:
+        upgrade_db(engine)
+
+    return engine
+
+def dispose_engines():
+    """
+    Close every engine kept open by open_db(persistent=True).
+    """
+    for engine, file_id in engines.values():
+        engine.dispose()
+    engines.clear()
+
+def get_file_id(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_dev, stat.st_ino
+
+def apply_pragmas(connection, pragmas):
+    """
+    Apply the given pragmas to the given DBAPI connection.
+    """
+    cursor = connection.cursor()
+    for key, value in pragmas.items():
+        if value is not None:
+            cursor.execute('PRAGMA {} = {}'.format(key, value))
+    cursor.close()
+
+def get_query_plan(session, function):
+    """
+    Call the given function, and return the plan SQLite used for the last 
+    query it executed, as a list of strings (e.g. 'SEARCH payments USING 
+    INDEX ...').  This is used by the tests and by contrib/benchmark.py to make 
+    sure that queries are using the right indexes.
+    """
+    statements = []
+
+    def record_statement(connection, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    engine = session.get_bind()
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', record_statement)
+    try:
+        function()
+    finally:
+        sqlalchemy.event.remove(engine, 'before_cursor_execute', record_statement)
+
+    statement, parameters = statements[-1]
+    plan = session.connection().exec_driver_sql(
+            'EXPLAIN QUERY PLAN ' + statement, parameters)
+    return [row[-1] for row in plan]
+
+def download_payments(session, username_callback, password_callback, show_browser=False, workers=None):
+    """
+    Download new transactions from every bank.
+
+    Each bank is scraped in its own thread (and therefore its own browser), 
+    because scraping spends almost all of its time waiting for web pages to 
+    load.  The number of banks that are scraped at once can be limited with 
+    the workers argument; by default all the banks are scraped at once.  The 
+    database is only written once every bank has finished downloading.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    banks = get_banks(session)
+    if not banks:
+        return []
+
+    # Prompt for usernames and passwords up front, one bank at a time, so the 
+    # prompts don't get interleaved.
+
+    downloads = [
+            bank.prepare_download(
+                username_callback, password_callback, show_browser)
+            for bank in banks
+    ]
+
+    with ThreadPoolExecutor(max_workers=workers or len(banks)) as executor:
+        futures = [executor.submit(x) for x in downloads]
+        accounts = [x.result() for x in futures]
+
+    return [
+            bank.record_payments(x)
+            for bank, x in zip(banks, accounts)
+    ]
+
+def import_ofx(session, bank, paths):
+    """
+    Record the transactions in the given OFX/QFX files (or directories of such 
+    files) as payments from the given bank.  Transactions that are already in 
+    the database are skipped, and an IngestResult is returned.
+    """
+    from . import ofx
+    paths = ofx.find_files(paths)
+    return ingest_transactions(session, bank, ofx.iter_files(paths))
+
+def update_allowances(session, as_of=None):
+    """
+    Add the money that each budget has accrued since it was last updated to 
+    its balance.  Every budget is updated to the same instant (now, by default) 
+    by a single UPDATE statement.
+    """
+    as_of = as_of or now()
+    session.flush()
+    session.query(Budget).update({
+            Budget.balance: accrued_balance_sql(as_of),
+            Budget.last_update: as_of,
+    }, synchronize_session=False)
+
+    for object in session.identity_map.values():
+        if isinstance(object, Budget):
+            session.expire(object, ['balance', 'last_update'])
+
+def forecast_balances(session, as_of):
+    """
+    Return a dictionary mapping each budget to the balance it will have at the 
+    given time, assuming no more payments are made.  Nothing is written to the 
+    database.
+    """
+    balance = sqlalchemy.type_coerce(accrued_balance_sql(as_of), PreciseDollars)
+    return dict(session.query(Budget, balance).order_by(Budget.id))
+
+def accrued_balance_sql(as_of):
+    """
+    Return an SQL expression for the balance each budget will have at the 
+    given time, once its allowance has accrued.
+
+    This is the same integer arithmetic that Budget.update_allowance() does, 
+    but SQLite integers are only 64 bits wide and the product of the allowance 
+    (in micro-cents per day) and the time elapsed (in microseconds) can easily 
+    overflow that.  So the time is split into whole days (d) and microseconds 
+    (t < D), the allowance is split into multiples of M = 10**6 (a1) and the 
+    remainder (a0), and the accrued money is calculated as:
+
+        a*d + (a1*t + a0*t // M) // (D/M)
+
+    which is exactly a*(d*D + t) // D for non-negative values, but never has an 
+    intermediate result larger than about 10**17.
+    """
+    def integer(x):
+        return sqlalchemy.type_coerce(x, Integer)
+
+    def microseconds(time):
+        # SQLAlchemy stores datetimes as 'YYYY-MM-DD HH:MM:SS.ffffff'.
+        seconds = sqlalchemy.cast(sqlalchemy.func.strftime('%s', time), Integer)
+        fraction = sqlalchemy.cast(sqlalchemy.func.substr(time, 21, 6), Integer)
+        return seconds * 10**6 + fraction
+
+    M = 10**6
+    D = seconds_per_day * M
+
+    as_of = sqlalchemy.literal(as_of, DateTime)
+    elapsed = microseconds(as_of) - microseconds(Budget.last_update)
+    days, remainder = elapsed // D, elapsed % D
+
+    allowance = integer(Budget.allowance)
+    a1, a0 = allowance // M, allowance % M
+
+    accrued = allowance * days + (a1 * remainder + a0 * remainder // M) // seconds_per_day
+    return integer(Budget.balance) + accrued
 
 def rename_budget(session, old_name, new_name):
     budget = get_budget(session, old_name)
     budget.name = new_name
 
-    # Update any payments that were assigned to this budget.  This exposes some 
-    # bad database design; I wouldn't have to do this if the assignment field 
-    # were a foreign key (although I'm not totally sure how the "ignore" 
-    # assignment would be handled in such a schema).
-
-    for payment in get_payments(session, old_name):
-        payment.assignment = new_name
+def remove_budget(session, name):
+    """
+    Delete the given budget.  Any payments that were assigned to it are marked 
+    as ignored, since there's no longer a budget to cover them and they 
+    shouldn't be presented to the user as unassigned either.
+    """
+    budget = get_budget(session, name)
+    session.query(Payment)\
+            .filter(Payment.budget_id == budget.id)\
+            .update({Payment.budget_id: None, Payment.ignored: True},
+                    synchronize_session=False)
+    expire_assignments(session)
+    session.query(Rule)\
+            .filter(Rule.budget_id == budget.id)\
+            .delete(synchronize_session=False)
+    session.delete(budget)
 
 def suggest_allowance(session, budget):
     """
@@ -362,18 +1473,43 @@ def suggest_allowance(session, budget):
     spending for the given account and returns that information in units of 
     dollars per month.
     """
-    payments = get_payments(session, budget.name)
+    return suggest_allowances(session, [budget])[budget]
 
-    if not payments:
-        return 0
+def suggest_allowances(session, budgets):
+    """
+    Suggest allowances for all of the given budgets at once.  Return a 
+    dictionary mapping each budget to its suggested allowance, in dollars per 
+    month.
 
-    elapsed_money = sum(x.value for x in payments)
-    elapsed_time = now().date() - min(x.date for x in payments)
+    The total and the date of the earliest payment for every budget are 
+    calculated by a single aggregate query, so the payments themselves are 
+    never loaded.
+    """
+    ids = [x.id for x in budgets]
+    query = session.query(
+                Payment.budget_id,
+                sqlalchemy.func.sum(Payment.value),
+                sqlalchemy.func.min(Payment.date))\
+            .filter(Payment.budget_id.in_(ids))\
+            .group_by(Payment.budget_id)
 
-    if not elapsed_time.days:
-        return 0
+    stats = {id: (total, first_date) for id, total, first_date in query}
+    today = now().date()
+    suggestions = {}
 
-    return -elapsed_money / elapsed_time.days * days_per_month
+    for budget in budgets:
+        suggestions[budget] = 0
+
+        if budget.id not in stats:
+            continue
+
+        elapsed_money, first_date = stats[budget.id]
+        elapsed_time = today - first_date
+
+        if elapsed_time.days:
+            suggestions[budget] = -elapsed_money / elapsed_time.days * days_per_month
+
+    return suggestions
 
 def transfer_money(dollars, from_budget, to_budget):
     from_budget.balance -= dollars
@@ -437,6 +1573,25 @@ def parse_allowance(allowance):
 
     return dollars / days
 
+def parse_date(date):
+    """
+    Convert the given string to a date.  Both ISO dates (e.g. 2014-01-31) and 
+    the format used by format_date() (e.g. 01/31/14) are understood.
+    """
+    for format in ('%Y-%m-%d', '%m/%d/%y', '%m/%d/%Y'):
+        try: return datetime.datetime.strptime(date, format).date()
+        except ValueError: pass
+
+    raise DateError(date)
+
+def as_date(date):
+    """
+    Convert the given datetime to a date.  Dates are returned unchanged.
+    """
+    if isinstance(date, datetime.datetime):
+        return date.date()
+    return date
+
 def format_date(date):
     return date.strftime('%m/%d/%y')
 
@@ -477,6 +1632,12 @@ class AllowanceError (UserError):
 class AssignmentError (UserError):
     pass
 
+class DateError (UserError):
+
+    def __init__(self, value):
+        self.message = "Expected a date like YYYY-MM-DD or MM/DD/YY, not '{}'.".format(value)
+
+
 class MoneyError (UserError):
 
     def __init__(self, value):
@@ -501,14 +1662,20 @@ class NoSuchBank (UserError):
         self.message = "No bank named '{}'.".format(scraper_key)
 
 
+class NoSuchRule (UserError):
+
+    def __init__(self, rule_id):
+        self.message = "No rule with id='{}'.".format(rule_id)
+
+
 class NoSuchScraper (UserError):
 
     def __init__(self, scraper_key):
         self.message = "Bank '{}' is not supported.\n".format(scraper_key)
-        if len(scraper_classes) == 1:
-            self.message += "Only '{}' is supported at present.".format(list(scraper_classes.keys())[0])
+        if len(scrapers) == 1:
+            self.message += "Only '{}' is supported at present.".format(list(scrapers.keys())[0])
         else:
-            self.message += "Supported banks: " + ', '.join("'{}'".format(x) for x in scraper_classes)
+            self.message += "Supported banks: " + ', '.join("'{}'".format(x) for x in scrapers)
 
 
 
@@ -0,0 +1,569 @@
+#!/usr/bin/env python3
+
+"""
+Download and parse financial data in the OFX format, without a browser.
+
+Many banks run an "OFX Direct Connect" server, which is what programs like
+Quicken and GnuCash use to download transactions.  Talking to that server
+directly is much faster than scraping the bank's website, because it only
+takes one HTTP request per account.
+"""
+
+import codecs
+import datetime
+import decimal
+import html
+import http.client
+import io
+import os
+import re
+import urllib.parse
+import uuid
+
+from .model import UserError
+
+class DirectConnect:
+    """
+    Download transactions from a bank's OFX Direct Connect server.
+
+    The constructor has the same signature as the browser-based scrapers (the
+    gui argument is accepted but ignored), and download() returns the same
+    account objects, so Bank.download_payments() doesn't need to know which
+    kind of scraper it's using.  Subclasses should fill in the url, org and fid
+    attributes for a particular bank.
+    """
+    url = None
+    org = None
+    fid = None
+
+    # Some servers refuse to talk to clients they don't recognize, so pretend
+    # to be a recent version of Quicken.
+    app_id = 'QWIN'
+    app_version = '2500'
+
+    def __init__(self, username, password, gui=False, url=None, org=None, fid=None, timeout=30):
+        self.username = username
+        self.password = password
+        self.url = url or self.url
+        self.org = org or self.org
+        self.fid = fid or self.fid
+        self.timeout = timeout
+
+    def download(self, from_date=None, to_date=None, account_dates=None):
+        """
+        Download transactions between the given dates for every account.  The 
+        account_dates argument can map account numbers to the date to start 
+        downloading that particular account from, instead of from_date.
+        """
+        if to_date is None: to_date = datetime.date.today()
+        if from_date is None: from_date = to_date - datetime.timedelta(30)
+        account_dates = account_dates or {}
+
+        accounts = []
+
+        with Connection(self.url, self.timeout) as connection:
+            response = connection.post(self._account_info_request())
+            check_status(response)
+
+            for account_type, account_from in parse_account_info(response):
+                account_number = re.search(r'<ACCTID>([^<\r\n]*)', account_from)
+                account_number = account_number and account_number.group(1).strip()
+                request = self._statement_request(
+                        account_type, account_from,
+                        account_dates.get(account_number, from_date), to_date)
+                response = connection.post(request)
+                check_status(response)
+                accounts += parse(io.BytesIO(response))
+
+        return accounts
+
+    def _account_info_request(self):
+        return self._request('''\
+<SIGNUPMSGSRQV1>
+<ACCTINFOTRNRQ>
+<TRNUID>{uid}
+<ACCTINFORQ>
+<DTACCTUP>19700101
+</ACCTINFORQ>
+</ACCTINFOTRNRQ>
+</SIGNUPMSGSRQV1>
+'''.format(uid=new_uid()))
+
+    def _statement_request(self, account_type, account_from, from_date, to_date):
+        if account_type == 'CCACCTFROM':
+            template = '''\
+<CREDITCARDMSGSRQV1>
+<CCSTMTTRNRQ>
+<TRNUID>{uid}
+<CCSTMTRQ>
+<CCACCTFROM>
+{account_from}</CCACCTFROM>
+<INCTRAN>
+<DTSTART>{from_date}
+<DTEND>{to_date}
+<INCLUDE>Y
+</INCTRAN>
+</CCSTMTRQ>
+</CCSTMTTRNRQ>
+</CREDITCARDMSGSRQV1>
+'''
+        else:
+            template = '''\
+<BANKMSGSRQV1>
+<STMTTRNRQ>
+<TRNUID>{uid}
+<STMTRQ>
+<BANKACCTFROM>
+{account_from}</BANKACCTFROM>
+<INCTRAN>
+<DTSTART>{from_date}
+<DTEND>{to_date}
+<INCLUDE>Y
+</INCTRAN>
+</STMTRQ>
+</STMTTRNRQ>
+</BANKMSGSRQV1>
+'''
+        return self._request(template.format(
+                uid=new_uid(),
+                account_from=account_from,
+                from_date=format_date(from_date),
+                to_date=format_date(to_date),
+        ))
+
+    def _request(self, body):
+        header = '''\
+OFXHEADER:100
+DATA:OFXSGML
+VERSION:102
+SECURITY:NONE
+ENCODING:USASCII
+CHARSET:1252
+COMPRESSION:NONE
+OLDFILEUID:NONE
+NEWFILEUID:{uid}
+
+<OFX>
+<SIGNONMSGSRQV1>
+<SONRQ>
+<DTCLIENT>{now}
+<USERID>{username}
+<USERPASS>{password}
+<LANGUAGE>ENG
+<FI>
+<ORG>{org}
+<FID>{fid}
+</FI>
+<APPID>{app_id}
+<APPVER>{app_version}
+</SONRQ>
+</SIGNONMSGSRQV1>
+'''
+        header = header.format(
+                uid=new_uid(),
+                now=datetime.datetime.now().strftime('%Y%m%d%H%M%S'),
+                username=escape(self.username),
+                password=escape(self.password),
+                org=self.org,
+                fid=self.fid,
+                app_id=self.app_id,
+                app_version=self.app_version,
+        )
+        request = header + body + '</OFX>\n'
+        return request.replace('\n', '\r\n').encode('cp1252')
+
+
+class WellsFargoDirectConnect (DirectConnect):
+    url = 'https://ofxdc.wellsfargo.com/ofx/process.ofx'
+    org = 'WF'
+    fid = '3000'
+
+
+class Connection:
+    """
+    A persistent HTTP connection to an OFX server.
+
+    Every request made through the same Connection reuses the same socket
+    (via HTTP/1.1 keep-alive), so downloading several accounts only pays for
+    one TCP and TLS handshake.  If the server closes the connection between
+    requests, it is transparently reopened.
+    """
+
+    def __init__(self, url, timeout=30):
+        url = urllib.parse.urlsplit(url)
+
+        if url.scheme == 'https':
+            self.connection_class = http.client.HTTPSConnection
+        elif url.scheme == 'http':
+            self.connection_class = http.client.HTTPConnection
+        else:
+            raise OfxError("Expected an http or https URL, not '{}'.".format(url.geturl()))
+
+        self.host = url.netloc
+        self.path = url.path or '/'
+        if url.query: self.path += '?' + url.query
+        self.timeout = timeout
+        self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def post(self, body):
+        headers = {
+                'Content-Type': 'application/x-ofx',
+                'Accept': '*/*, application/x-ofx',
+                'Connection': 'keep-alive',
+        }
+
+        # Retry once if the server dropped the connection since the last
+        # request, which keep-alive connections are allowed to do.
+
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = self.connection_class(
+                        self.host, timeout=self.timeout)
+            try:
+                self.connection.request('POST', self.path, body, headers)
+                response = self.connection.getresponse()
+                content = response.read()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self.close()
+                if attempt: raise
+
+        if response.status != 200:
+            raise OfxError("OFX server returned HTTP {} {}.".format(
+                response.status, response.reason))
+
+        if response.will_close:
+            self.close()
+
+        return content
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class Account:
+    """
+    The transactions downloaded for one account.  This mimics the account 
+    objects created by ofxparse, but only has the attributes two_cents uses.
+    """
+
+    def __init__(self, number):
+        self.number = number
+        self.statement = Statement()
+
+    def __repr__(self):  # pragma: no cover
+        return '<Account number={0.number} transactions={1}>'.format(
+                self, len(self.statement.transactions))
+
+
+class Statement:
+
+    def __init__(self):
+        self.transactions = []
+
+
+class Transaction:
+
+    __slots__ = 'id', 'date', 'amount', 'payee', 'memo'
+
+    def __init__(self, id, date, amount, payee='', memo=''):
+        self.id = id
+        self.date = date
+        self.amount = amount
+        self.payee = payee
+        self.memo = memo
+
+    def __repr__(self):  # pragma: no cover
+        return '<Transaction id={0.id} date={0.date} amount={0.amount}>'.format(self)
+
+
+def parse(ofx_file):
+    """
+    Parse an OFX file and return a list of accounts, each with a statement 
+    containing all the transactions for that account.
+    """
+    accounts = {}
+
+    for number, transaction in iter_transactions(ofx_file):
+        if number not in accounts:
+            accounts[number] = Account(number)
+        accounts[number].statement.transactions.append(transaction)
+
+    return list(accounts.values())
+
+def parse_files(paths, workers=None):
+    """
+    Parse the given OFX files and return a list of accounts.
+
+    Parsing is CPU-bound, so when there's more than one file, the files are 
+    parsed in parallel by a pool of worker processes (at most one per file or 
+    CPU, unless a number of workers is given).  The results are merged 
+    in a deterministic order: files are processed in sorted order, accounts 
+    are listed in the order they first appear, and the transactions for each 
+    account are listed in the order they appear in the files.
+    """
+    paths = sorted(paths)
+
+    if workers is None:
+        workers = min(len(paths), os.cpu_count() or 1)
+
+    if len(paths) > 1 and workers > 1:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # This can be called from the threads that scrape several banks at 
+        # once, and forking a process with other threads running (e.g. ones 
+        # driving a browser) can deadlock the child.  So start the workers 
+        # from a fresh server process instead.
+
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context(
+                'forkserver' if 'forkserver' in methods else 'spawn')
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            results = list(executor.map(parse_path, paths))
+    else:
+        results = [parse_path(x) for x in paths]
+
+    accounts = {}
+
+    for result in results:
+        for account in result:
+            if account.number not in accounts:
+                accounts[account.number] = account
+            else:
+                accounts[account.number].statement.transactions += \
+                        account.statement.transactions
+
+    return list(accounts.values())
+
+def parse_path(path):
+    with open(path, 'rb') as ofx_file:
+        return parse(ofx_file)
+
+def find_files(paths):
+    """
+    Return a sorted list of the OFX/QFX files in the given paths.  Files are 
+    included as-is, while directories are searched recursively for files with 
+    the '.ofx' or '.qfx' extensions.
+    """
+    ofx_paths = []
+
+    for path in paths:
+        if os.path.isdir(path):
+            for dir, subdirs, files in os.walk(path):
+                ofx_paths += [
+                        os.path.join(dir, x) for x in files
+                        if os.path.splitext(x)[1].lower() in ('.ofx', '.qfx')
+                ]
+        elif os.path.exists(path):
+            ofx_paths.append(path)
+        else:
+            raise OfxError("No such file or directory: '{}'".format(path))
+
+    return sorted(ofx_paths)
+
+def iter_files(paths):
+    """
+    Yield an (account number, transaction) tuple for each transaction in the 
+    given files.  Each file is streamed, so only one chunk of one file is in 
+    memory at a time.
+    """
+    for path in paths:
+        with open(path, 'rb') as ofx_file:
+            yield from iter_transactions(ofx_file)
+
+def iter_transactions(ofx_file, chunk_size=65536):
+    """
+    Yield an (account number, transaction) tuple for each transaction in the 
+    given OFX or QFX file, which must be opened in binary mode.
+
+    The file is read a chunk at a time and each transaction is yielded as soon 
+    as it has been read, so memory usage doesn't depend on how big the file 
+    is, and the caller can start processing transactions right away.  Both the 
+    SGML (v1) and XML (v2) dialects of OFX are understood.  Only the elements 
+    that two_cents needs are extracted; everything else is skipped.
+    """
+    account_number = None
+    in_account = False
+    transaction = None
+
+    for is_closing, tag, text in iter_elements(ofx_file, chunk_size):
+        if is_closing:
+            if tag == 'STMTTRN' and transaction is not None:
+                yield account_number, make_transaction(transaction)
+                transaction = None
+            elif tag in account_aggregates:
+                in_account = False
+
+        elif tag == 'STMTTRN':
+            transaction = {}
+
+        elif transaction is not None:
+            # Keep the first value of each element, so that (for example) the 
+            # name of a payee isn't overwritten by the name of a bank in some 
+            # nested aggregate.
+            if text and tag not in transaction:
+                transaction[tag] = text
+
+        elif tag in account_aggregates:
+            in_account = True
+
+        elif tag == 'ACCTID' and in_account:
+            account_number = text
+
+def iter_elements(ofx_file, chunk_size=65536):
+    """
+    Yield an (is closing, tag, text) tuple for each tag in the given OFX file.
+
+    The text is whatever comes between the tag and the next tag, stripped of 
+    whitespace and with any SGML entities decoded.  SGML-style OFX doesn't 
+    close elements that contain text, so the text is the only reliable way to 
+    distinguish elements from aggregates.
+    """
+    # Read enough of the file to be sure the whole header is included, even if 
+    # the chunks are small.
+    head = ofx_file.read(max(chunk_size, 4096))
+    decoder = codecs.getincrementaldecoder(guess_encoding(head))('replace')
+    buffer = decoder.decode(head)
+
+    # Everything before the first tag is the header, which two_cents doesn't 
+    # need.  Likewise for the processing instructions that start XML files.
+
+    start = buffer.find('<')
+    buffer = buffer[start:] if start >= 0 else ''
+
+    while True:
+        chunk = ofx_file.read(chunk_size)
+        buffer += decoder.decode(chunk, final=not chunk)
+
+        # Only process up to the last tag in the buffer, because the text 
+        # following that tag (or the tag itself) may be continued in the next 
+        # chunk.
+
+        end = len(buffer) if not chunk else buffer.rfind('<')
+
+        for match in element_pattern.finditer(buffer, 0, max(end, 0)):
+            is_closing, tag, text = match.groups()
+            if not tag.startswith('?'):
+                yield bool(is_closing), tag.upper(), html.unescape(text.strip())
+
+        if not chunk:
+            break
+
+        buffer = buffer[end:] if end > 0 else buffer
+
+def make_transaction(fields):
+    id = fields.get('FITID')
+
+    if not fields.get('DTPOSTED'):
+        raise OfxError("Transaction '{}' has no date.".format(id))
+
+    try:
+        date = parse_date(fields['DTPOSTED'])
+    except ValueError:
+        raise OfxError("Transaction '{}' has an invalid date: '{}'".format(id, fields['DTPOSTED']))
+
+    try:
+        amount = parse_amount(fields.get('TRNAMT', '0'))
+    except decimal.InvalidOperation:
+        raise OfxError("Transaction '{}' has an invalid amount: '{}'".format(id, fields['TRNAMT']))
+
+    return Transaction(
+            id=id,
+            date=date,
+            amount=amount,
+            payee=fields.get('NAME', ''),
+            memo=fields.get('MEMO', ''),
+    )
+
+def parse_date(date):
+    """
+    Convert an OFX timestamp (e.g. '20140101120000.000[-8:PST]') to a naive 
+    datetime.  Only the date and time fields are used; the time zone is 
+    ignored.
+    """
+    digits = re.match(r'\d*', date).group()
+    fields = [int(digits[i:j] or 0) for i, j in ((0,4), (4,6), (6,8), (8,10), (10,12), (12,14))]
+    return datetime.datetime(*fields)
+
+def parse_amount(amount):
+    """
+    Convert an OFX amount to a decimal.  The spec allows either a period or a 
+    comma as the decimal mark, and some banks also use the other character to 
+    separate thousands (e.g. '1,000.00' or '1.000,00').  If both appear, the 
+    last one is the decimal mark.  A lone comma is always a decimal mark.
+    """
+    if ',' in amount and amount.rfind(',') > amount.rfind('.'):
+        amount = amount.replace('.', '').replace(',', '.')
+    else:
+        amount = amount.replace(',', '')
+
+    return decimal.Decimal(amount)
+
+def guess_encoding(head):
+    """
+    Guess how an OFX file is encoded by looking at its header.
+    """
+    if re.search(rb'ENCODING:\s*UTF-?8|encoding=.UTF-?8', head, re.IGNORECASE):
+        return 'utf-8'
+    else:
+        return 'cp1252'
+
+def parse_account_info(response):
+    """
+    Yield an (aggregate name, aggregate contents) tuple for each account
+    listed in an account information response.  The aggregate name is either
+    'BANKACCTFROM' or 'CCACCTFROM', and the contents can be pasted verbatim
+    into a statement request.
+    """
+    response = response.decode('cp1252')
+    pattern = re.compile(r'<(BANKACCTFROM|CCACCTFROM)>(.*?)</\1>', re.DOTALL)
+
+    # The same account can be listed more than once, e.g. if it supports both
+    # downloading statements and paying bills.
+
+    seen = set()
+    for match in pattern.finditer(response):
+        account_type, contents = match.groups()
+        contents = ''.join(x.strip() + '\n' for x in contents.splitlines() if x.strip())
+        if (account_type, contents) not in seen:
+            seen.add((account_type, contents))
+            yield account_type, contents
+
+def check_status(response):
+    """
+    Raise an OfxError if the server reported that any part of the request
+    failed (e.g. because the password was wrong).
+    """
+    response = response.decode('cp1252')
+    pattern = re.compile(r'<STATUS>\s*<CODE>\s*(\d+)\s*<SEVERITY>\s*(\w+)(?:\s*<MESSAGE>([^<\r\n]*))?')
+
+    for code, severity, message in pattern.findall(response):
+        if severity == 'ERROR':
+            raise OfxError("OFX server returned error {}{}".format(
+                code, ': ' + message.strip() if message else '.'))
+
+account_aggregates = 'BANKACCTFROM', 'CCACCTFROM'
+element_pattern = re.compile(r'<(/?)([^>\s/]+)[^>]*>([^<]*)')
+
+def format_date(date):
+    return date.strftime('%Y%m%d')
+
+def escape(value):
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def new_uid():
+    return uuid.uuid4().hex.upper()
+
+
+class OfxError (UserError):
+    pass
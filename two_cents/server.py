@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+"""
+Serve two_cents commands over a Unix socket.
+
+Most of the time it takes to run a quick command like ``two_cents -D`` is 
+spent importing SQLAlchemy and opening the database.  The server does that 
+once, then runs commands forwarded by two_cents_client (see the top-level 
+two_cents_client.py) in the same process.  The protocol is one JSON object 
+per line.  The client sends its arguments, working directory, and 
+environment::
+
+    {"argv": [...], "cwd": "/path", "env": {...}}
+
+and the server replies with any number of these messages, followed by an 
+exit code::
+
+    {"print": "text"}
+    {"prompt": "message", "password": false}
+    {"exit": 0}
+
+The client must answer each prompt with ``{"response": "text"}``, or with 
+``{"interrupt": true}`` if the user hit Ctrl-C or Ctrl-D.
+
+Commands are run one at a time, so concurrent clients never write to the 
+database at the same time (and never see each other's output).  This also 
+means that a command waiting for input holds up everyone else.
+"""
+
+import contextlib
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+
+from .model import UserError, dispose_engines, open_db
+
+def serve(socket_path, db_path):
+    """
+    Run commands sent to the given socket until interrupted.
+    """
+    socket_path = os.path.abspath(os.path.expanduser(socket_path))
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    remove_stale_socket(socket_path)
+
+    # Open the database before accepting any connections, so that any problems 
+    # with it are reported now and so that the first command is as fast as the 
+    # rest.
+
+    with open_db(db_path, persistent=True):
+        pass
+
+    server = Server(socket_path, db_path)
+    try:
+        print("Listening on '{}'...".format(socket_path))
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+        dispose_engines()
+
+def remove_stale_socket(socket_path):
+    """
+    Delete the given socket if it was left behind by a server that didn't shut 
+    down cleanly, or complain if another server is still using it.
+    """
+    if not os.path.exists(socket_path):
+        return
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_path)
+        except ConnectionRefusedError:
+            os.unlink(socket_path)
+        else:
+            raise ServerError("A two_cents server is already listening on '{}'.".format(socket_path))
+
+
+class Server (socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, db_path):
+        # The working directory changes with each client, so make sure the 
+        # database path doesn't.
+        self.db_path = os.path.abspath(os.path.expanduser(db_path))
+        self.lock = threading.Lock()
+        super().__init__(socket_path, RequestHandler)
+
+    def server_bind(self):
+        # Only the user who started the server can connect to it, since 
+        # anyone who can connect can read and change every budget.
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+
+
+class RequestHandler (socketserver.StreamRequestHandler):
+
+    def handle(self):
+        request = self.receive()
+        if request is None:
+            return
+
+        with self.server.lock, client_environment(request):
+            exit_code = self.run(request['argv'])
+
+        with contextlib.suppress(OSError):
+            self.send(exit=exit_code)
+
+    def run(self, argv):
+        from . import cli
+
+        # Commands print via sys.stdout and prompt via cli.prompt(), so both 
+        # are redirected to the client while the command runs.  This is only 
+        # safe because commands are run one at a time.
+
+        output = ClientOutput(self)
+        original_prompt = cli.prompt
+        cli.prompt = self.prompt
+
+        try:
+            with contextlib.redirect_stdout(output):
+                try:
+                    cli.main(argv, self.server.db_path, persistent=True)
+                    return 0
+                except SystemExit as exit:
+                    if exit.code is None or isinstance(exit.code, int):
+                        return exit.code or 0
+                    print(exit.code)
+                    return 1
+                except Exception:
+                    traceback.print_exc(file=sys.stdout)
+                    return 1
+                finally:
+                    output.flush()
+        finally:
+            cli.prompt = original_prompt
+
+    def prompt(self, message, password=False):
+        sys.stdout.flush()
+        try:
+            self.send(prompt=message, password=password)
+            reply = self.receive()
+        except OSError:
+            reply = None
+
+        if reply is None or 'response' not in reply:
+            raise KeyboardInterrupt
+        return reply['response']
+
+    def send(self, **message):
+        self.wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+    def receive(self):
+        line = self.rfile.readline()
+        return json.loads(line.decode('utf-8')) if line else None
+
+
+@contextlib.contextmanager
+def client_environment(request):
+    """
+    Run commands in the client's working directory and environment, so that 
+    relative paths (e.g. for import_ofx or export) and environment variables 
+    (e.g. for the username and password commands) mean what the user expects.  
+    This changes the whole process, so it's only safe while the lock is held.
+    """
+    cwd, environ = os.getcwd(), dict(os.environ)
+    try:
+        os.chdir(request.get('cwd', cwd))
+        os.environ.clear()
+        os.environ.update(request.get('env', environ))
+        yield
+    finally:
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+
+
+class ClientOutput (io.TextIOBase):
+    """
+    Buffer text written by a command and send it to the client in chunks.
+    """
+
+    def __init__(self, handler, buffer_size=65536):
+        self.handler = handler
+        self.buffer = []
+        self.buffer_len = 0
+        self.buffer_size = buffer_size
+        self.disconnected = False
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.buffer_len += len(text)
+        if self.buffer_len > self.buffer_size:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        text = ''.join(self.buffer)
+        self.buffer = []
+        self.buffer_len = 0
+
+        # If the client went away, let the command finish anyway rather than 
+        # leaving the database half-updated.
+        if text and not self.disconnected:
+            try:
+                self.handler.send(print=text)
+            except OSError:
+                self.disconnected = True
+
+
+class ServerError (UserError):
+    pass
+
+
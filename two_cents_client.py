@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+"""
+Run a two_cents command using a two_cents server, if one is running.
+
+This module is deliberately kept separate from the two_cents package, because 
+importing two_cents means importing SQLAlchemy, and avoiding that is the whole 
+point of the server.  If no server is listening, the command is run normally. 
+The arguments are the same as for two_cents.  The socket is found in the same 
+place the server puts it by default, or at $TWO_CENTS_SOCKET if that is set.
+"""
+
+import json
+import os
+import socket
+import sys
+
+# Commands that always run in the client, because they need the client's 
+# terminal (e.g. to open an editor) or don't make sense to forward.
+local_commands = {'describe_budgets', 'serve'}
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # Hold on to stdout now, in case the server is running in this process 
+    # (i.e. in the tests) and redirects it.
+
+    stdout = sys.stdout
+
+    if argv and argv[0] in local_commands:
+        return run_locally(argv)
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        client.connect(get_socket_path())
+    except OSError:
+        client.close()
+        return run_locally(argv)
+
+    with client, client.makefile('rwb') as file:
+        send(file, argv=argv, cwd=os.getcwd(), env=dict(os.environ))
+
+        while True:
+            message = receive(file)
+
+            if message is None:
+                return "Lost connection to the two_cents server."
+
+            if 'print' in message:
+                stdout.write(message['print'])
+                stdout.flush()
+
+            elif 'prompt' in message:
+                try:
+                    response = prompt(message['prompt'], message['password'])
+                except (EOFError, KeyboardInterrupt):
+                    send(file, interrupt=True)
+                else:
+                    send(file, response=response)
+
+            elif 'exit' in message:
+                return message['exit']
+
+def run_locally(argv):
+    from two_cents.cli import main
+    return main(argv)
+
+def get_socket_path():
+    path = os.environ.get('TWO_CENTS_SOCKET')
+    if path:
+        return os.path.expanduser(path)
+
+    import appdirs
+    dirs = appdirs.AppDirs('two_cents', 'username')
+    return os.path.join(dirs.user_config_dir, 'server.sock')
+
+def prompt(message, password=False):
+    if password:
+        import getpass
+        return getpass.getpass(message)
+    else:
+        return input(message)
+
+def send(file, **message):
+    file.write(json.dumps(message).encode('utf-8') + b'\n')
+    file.flush()
+
+def receive(file):
+    line = file.readline()
+    return json.loads(line.decode('utf-8')) if line else None
+
+
+if __name__ == '__main__':
+    sys.exit(main())